@@ -1 +1,4 @@
+from app.api.admin_api import router as admin_router
+from app.api.alert_api import router as alert_router
 from app.api.crypto_api import router
+from app.api.user_api import router as user_router
@@ -0,0 +1,50 @@
+from typing import Any, Dict, List
+
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import JSONResponse
+
+from app.config import settings
+from app.services.profiling import (get_captured_profile,
+                                    get_captured_profiles, is_admin)
+
+
+def require_admin(request: Request):
+    if settings.PROFILING_ADMIN_TOKEN is None:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin endpoints are disabled, set PROFILING_ADMIN_TOKEN to enable them",
+        )
+    if not is_admin(request):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Invalid admin token"
+        )
+
+
+router = APIRouter(prefix="/admin", dependencies=[Depends(require_admin)])
+
+
+@router.get("/profiles", response_model=List[Dict[str, Any]])
+def get_profiles():
+    """
+    Get the summaries (time breakdown by SQL, Redis and HTTP) of the captured request profiles, newest first.
+    """
+    return [profile.summary() for profile in reversed(get_captured_profiles())]
+
+
+@router.get("/profiles/{profile_id}")
+def download_profile(profile_id: str):
+    """
+    Download a captured request profile with all its spans and stack samples (folded format).
+    """
+    profile = get_captured_profile(profile_id)
+    if profile is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Profile with ID '{profile_id}' not found (it may have been dropped from the buffer)",
+        )
+    return JSONResponse(
+        profile.to_dict(),
+        headers={
+            "Content-Disposition": f"attachment; filename=profile-{profile_id}.json"
+        },
+    )
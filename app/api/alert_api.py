@@ -0,0 +1,85 @@
+import logging
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.orm import Session
+
+import app.crud as crud
+import app.schemas as schemas
+from app.db import get_db
+from app.services.alerts import (alert_condition_met, fire_price_alerts,
+                                 notify_price_alert_created,
+                                 notify_price_alerts_removed)
+from app.services.redis import get_fired_alerts_from_stream
+
+router = APIRouter(prefix="/api")
+
+logger = logging.getLogger(__name__)
+
+
+@router.post(
+    "/alerts",
+    response_model=schemas.PriceAlert,
+    status_code=status.HTTP_201_CREATED,
+)
+def create_price_alert(
+    alert_data: schemas.PriceAlertCreate, db: Session = Depends(get_db)
+):
+    """
+    Create a new price alert for a cryptocurrency in the system.
+    The alert fires once, when the metric crosses the threshold in the given direction
+    (or right away, if the condition is already met).
+    """
+    alert_data.symbol = alert_data.symbol.upper()
+
+    crypto = crud.get_cryptocurrency_response_by_symbol(
+        session=db, symbol=alert_data.symbol
+    )
+    if not crypto:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Cryptocurrency with symbol '{alert_data.symbol}' not found",
+        )
+
+    alert = crud.create_price_alert(session=db, alert=alert_data)
+    notify_price_alert_created(alert)
+    logger.info(f"Created price alert {alert.id} for '{alert.symbol}'")
+
+    # Read the value only after the alert was published to the indexes: a refresh which
+    # evaluated the alerts before has already stored its value
+    crypto = crud.get_cryptocurrency_response_by_symbol(session=db, symbol=alert.symbol)
+    value = ((crypto or {}).get("crypto_metadata") or {}).get(alert.metric)
+    if alert_condition_met(alert, value):
+        fire_price_alerts(session=db, alert_values={alert.id: (None, value)})
+        db.refresh(alert)
+    return alert
+
+
+@router.get("/alerts", response_model=List[schemas.PriceAlert])
+def get_price_alerts(
+    active: Optional[bool] = None,
+    limit: Optional[int] = None,
+    db: Session = Depends(get_db),
+):
+    """
+    Get a list of price alerts, optionally only the active (or only the fired) ones.
+    """
+    return crud.get_price_alerts(session=db, active=active, limit=limit)
+
+
+@router.get("/alerts/fired", response_model=List[Dict[str, str]])
+def get_fired_price_alerts(count: int = 100):
+    """
+    Get the most recently fired price alerts from the Redis stream 'alerts:fired'.
+    Consumers can also read the stream directly (e.g., with XREAD or a consumer group).
+    """
+    return get_fired_alerts_from_stream(count=count)
+
+
+@router.delete("/alerts/{alert_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_price_alert(alert_id: int, db: Session = Depends(get_db)):
+    """
+    Delete a price alert by its ID.
+    """
+    crud.delete_price_alert(session=db, alert_id=alert_id)
+    notify_price_alerts_removed([alert_id])
@@ -1,14 +1,27 @@
+import asyncio
+import csv
+import datetime
+import io
+import json
 import logging
-from typing import List, Optional
+import tempfile
+from typing import IO, Any, Dict, Iterator, List, Literal, Optional, Tuple
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import (APIRouter, BackgroundTasks, Depends, HTTPException,
+                     Request, status)
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 from sqlalchemy.orm import Session
 
 import app.crud as crud
+import app.models as models
 import app.schemas as schemas
-from app.db import get_db
+from app.db import SessionLocal, get_db
+from app.services.alerts import evaluate_price_alerts, metric_changes
 from app.services.coingecko import get_coin_metadata, validate_crypto_symbol
+from app.services.exchange_rates import add_valuations
 from app.services.redis import *
+from app.tasks.crypto_tasks import enrich_imported_cryptocurrencies_metadata
 from app.tasks.crypto_tasks import \
     refresh_all_cryptocurrencies_metadata as refresh_all_task
 
@@ -16,6 +29,10 @@ router = APIRouter(prefix="/api")
 
 logger = logging.getLogger(__name__)
 
+BulkFormat = Literal["ndjson", "csv"]
+EXPORT_COLUMNS = list(models.CryptocurrencyReadModel.__table__.columns.keys())
+EXPORT_CHUNK_ROWS = 1000  # Rows sent to the client per chunk
+
 
 @router.post(
     "/cryptocurrency",
@@ -26,22 +43,32 @@ async def create_cryptocurrency(
     crypto_data: schemas.CryptocurrencyCreate, db: Session = Depends(get_db)
 ):
     """
-    Create a new cryptocurrency.
+    Create a new cryptocurrency in the portfolio (the holdings of the default user).
+    Cryptocurrencies already added by other users are shared, only the amount is added.
     """
     # Convert symbol to uppercase, to avoid multiple coins with the same Coingecko IDs
     crypto_data.symbol = crypto_data.symbol.upper()
 
-    # Check if the cryptocurrency exists on CoinGecko
-    coingecko_id = await validate_crypto_symbol(crypto_data.symbol)
-    logger.info(
-        f"Matching symbol found on CoinGecko. Symbol: {crypto_data.symbol}, CoinGecko ID: {coingecko_id}"
-    )
+    crypto = crud.get_cryptocurrency_by_symbol(session=db, symbol=crypto_data.symbol)
+    if not crypto:
+        # Check if the cryptocurrency exists on CoinGecko
+        coingecko_id = await validate_crypto_symbol(crypto_data.symbol)
+        logger.info(
+            f"Matching symbol found on CoinGecko. Symbol: {crypto_data.symbol}, CoinGecko ID: {coingecko_id}"
+        )
 
-    # Fetch metadata from CoinGecko
-    coin_metadata = await get_coin_metadata(coingecko_id)
+        # Fetch metadata from CoinGecko
+        coin_metadata = await get_coin_metadata(coingecko_id)
 
-    new_crypto = crud.create_cryptocurrency(
-        session=db, crypto=crypto_data, metadata=coin_metadata
+        crypto = crud.create_cryptocurrency(
+            session=db, crypto=crypto_data, metadata=coin_metadata
+        )
+
+    crud.add_cryptocurrency_to_portfolio(
+        session=db, crypto=crypto, amount=crypto_data.amount or 0.0
+    )
+    new_crypto = crud.get_cryptocurrency_response_by_symbol(
+        session=db, symbol=crypto_data.symbol
     )
     insert_crypto_to_cache(
         symbol=crypto_data.symbol,
@@ -51,32 +78,46 @@ async def create_cryptocurrency(
 
 
 @router.get("/cryptocurrency/{symbol}", response_model=schemas.CryptocurrencyResponse)
-def get_cryptocurrency(symbol: str, db: Session = Depends(get_db)):
+def get_cryptocurrency(
+    symbol: str, currency: Optional[str] = None, db: Session = Depends(get_db)
+):
     """
     Get details of a specific cryptocurrency by its symbol.
+    Optionally, its values can be converted to another currency (e.g., EUR, CZK).
     """
     symbol = symbol.upper()  # Ensure the symbol is in uppercase
 
-    if check_crypto_in_cache(symbol):
-        return get_crypto_from_cache(symbol)
-
-    crypto = crud.get_cryptocurrency_by_symbol(session=db, symbol=symbol)
+    crypto = get_crypto_from_cache(symbol) if check_crypto_in_cache(symbol) else None
+    if crypto is None:
+        # Served from the denormalized read model, without building ORM objects
+        crypto = crud.get_cryptocurrency_response_by_symbol(session=db, symbol=symbol)
     if not crypto:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Cryptocurrency with symbol '{symbol}' not found",
         )
+
+    if currency is not None:
+        add_valuations([crypto], currency)
     return crypto
 
 
 @router.get("/cryptocurrencies", response_model=List[schemas.CryptocurrencyResponse])
 def get_all_cryptocurrencies(
-    limit: Optional[int] = None, db: Session = Depends(get_db)
+    limit: Optional[int] = None,
+    currency: Optional[str] = None,
+    db: Session = Depends(get_db),
 ):
     """
-    Get a list of all cryptocurrencies.
+    Get a list of all cryptocurrencies in the portfolio (the holdings of the default user).
+    Optionally, their values can be converted to another currency (e.g., EUR, CZK).
     """
-    return crud.get_all_cryptocurrencies(session=db, limit=limit)
+    cryptos = crud.get_all_cryptocurrency_responses(
+        session=db, limit=limit, portfolio_only=True
+    )
+    if currency is not None:
+        add_valuations(cryptos, currency)
+    return cryptos
 
 
 @router.put("/cryptocurrency/{symbol}", response_model=schemas.CryptocurrencyResponse)
@@ -87,6 +128,8 @@ def update_cryptocurrency(
 ):
     """
     Update details of a specific cryptocurrency by its symbol.
+    The name is shared by all the users (it is changed for everyone),
+    the amount is the one in the portfolio (the cryptocurrency is added to it if needed).
     """
     symbol = symbol.upper()  # Ensure the symbol is in uppercase
 
@@ -97,13 +140,20 @@ def update_cryptocurrency(
             detail=f"Cryptocurrency with symbol {symbol} not found",
         )
 
-    updated_crypto = crud.update_cryptocurrency(
-        session=db, symbol=symbol, crypto=crypto_data
+    crud.update_cryptocurrency(session=db, symbol=symbol, crypto=crypto_data)
+    updated_crypto = crud.get_cryptocurrency_response_by_symbol(
+        session=db, symbol=symbol
     )
 
-    if check_crypto_in_cache(symbol):
-        delete_crypto_from_cache(symbol)
-    insert_crypto_to_cache(symbol=symbol, model=updated_crypto)
+    # Only the changed fields are written to the cache
+    if not update_crypto_fields_in_cache(
+        symbol,
+        {
+            **crypto_data.model_dump(exclude_none=True),
+            "updated_at": updated_crypto["updated_at"],
+        },
+    ):
+        insert_crypto_to_cache(symbol=symbol, model=updated_crypto)
 
     return updated_crypto
 
@@ -111,7 +161,8 @@ def update_cryptocurrency(
 @router.delete("/cryptocurrency/{symbol}", status_code=status.HTTP_204_NO_CONTENT)
 def delete_cryptocurrency(symbol: str, db: Session = Depends(get_db)):
     """
-    Delete a specific cryptocurrency by its symbol.
+    Delete a specific cryptocurrency by its symbol, for all the users.
+    Refused with 409 while other users hold it, use DELETE /api/users/{user_id}/holdings/{symbol} instead.
     """
     symbol = symbol.upper()  # Ensure the symbol is in uppercase
 
@@ -138,17 +189,37 @@ async def refresh_cryptocurrency_metadata(symbol: str, db: Session = Depends(get
             detail=f"Cryptocurrency with symbol '{symbol}' not found",
         )
 
-    new_metadata = await get_coin_metadata(crypto.crypto_metadata.coingecko_id)
+    coingecko_id = (
+        crypto.crypto_metadata.coingecko_id if crypto.crypto_metadata else None
+    )
+    if coingecko_id is None:
+        # Imported cryptocurrencies are pending until their CoinGecko ID is looked up
+        coingecko_id = await validate_crypto_symbol(symbol)
+    new_metadata = await get_coin_metadata(coingecko_id)
+    old_metadata = (
+        schemas.CryptocurrencyMetadata.model_validate(crypto.crypto_metadata)
+        if crypto.crypto_metadata
+        else None
+    )
 
     # Update the metadata in the database and return the updated cryptocurrency
-    updated_crypto = crud.update_cryptocurrency_metadata(
+    crud.update_cryptocurrency_metadata(
         session=db, symbol=symbol, new_metadata=new_metadata
     )
+    updated_crypto = crud.get_cryptocurrency_response_by_symbol(
+        session=db, symbol=symbol
+    )
 
-    # Update the cache
-    if check_crypto_in_cache(symbol):
-        delete_crypto_from_cache(symbol)
-    insert_crypto_to_cache(symbol=symbol, model=updated_crypto)
+    # Update only the metadata fields in the cache
+    if not update_crypto_fields_in_cache(
+        symbol,
+        {**new_metadata.model_dump(), "updated_at": updated_crypto["updated_at"]},
+    ):
+        insert_crypto_to_cache(symbol=symbol, model=updated_crypto)
+
+    evaluate_price_alerts(
+        session=db, changes=metric_changes(symbol, old_metadata, new_metadata)
+    )
 
     return updated_crypto
 
@@ -158,6 +229,146 @@ async def refresh_all_cryptocurrencies_metadata():
     """
     Manually trigger a refresh of the data of all cryptocurrencies.
     This operation is also performed automatically every 30 minutes.
+    The coins are enqueued in batches, which are processed by the refresh workers.
+    """
+    batches = await refresh_all_task(force=True)
+    return {
+        "message": f"Manual refresh of all currencies metadata has been enqueued in {batches} batches."
+    }
+
+
+def _export_value(value: Any) -> Any:
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+
+def _export_chunks(format: BulkFormat) -> Iterator[str]:
+    """
+    Generate the export in chunks of EXPORT_CHUNK_ROWS rows.
+    Uses its own session, as the response is streamed after the endpoint returns.
+    """
+    db = SessionLocal()
+    try:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if format == "csv":
+            writer.writerow(EXPORT_COLUMNS)
+        for i, row in enumerate(crud.stream_cryptocurrency_responses(session=db)):
+            if format == "csv":
+                writer.writerow([_export_value(row[column]) for column in EXPORT_COLUMNS])
+            else:
+                buffer.write(
+                    json.dumps({column: _export_value(value) for column, value in row.items()})
+                )
+                buffer.write("\n")
+            if (i + 1) % EXPORT_CHUNK_ROWS == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    finally:
+        db.close()
+
+
+@router.get("/cryptocurrencies/export")
+def export_cryptocurrencies(format: BulkFormat = "ndjson"):
+    """
+    Export all cryptocurrencies, including their metadata, as a stream of NDJSON or CSV.
+    """
+    return StreamingResponse(
+        _export_chunks(format),
+        media_type="application/x-ndjson" if format == "ndjson" else "text/csv",
+        headers={
+            "Content-Disposition": f"attachment; filename=cryptocurrencies.{format}"
+        },
+    )
+
+
+def _read_import_records(
+    upload: io.TextIOBase, format: BulkFormat
+) -> Iterator[Dict[str, Any]]:
+    if format == "csv":
+        yield from csv.DictReader(upload)
+        return
+    for line in upload:
+        if line.strip():
+            yield json.loads(line)
+
+
+def _write_import_records(upload: IO[bytes], csv_file: IO[str], format: BulkFormat):
+    """
+    Validate the uploaded records and write them to the staging CSV in the order of the upload.
+    """
+    writer = csv.writer(csv_file)
+    records = _read_import_records(
+        io.TextIOWrapper(upload, encoding="utf-8", newline=""), format
+    )
+    imported_records = 0
+    try:
+        for record in records:
+            crypto = schemas.CryptocurrencyCreate(
+                symbol=record.get("symbol"),
+                name=record.get("name"),
+                amount=record.get("amount") if record.get("amount") != "" else None,
+            )
+            writer.writerow(
+                [
+                    imported_records,
+                    crypto.symbol.upper(),
+                    crypto.name,
+                    crypto.amount,
+                    record.get("coingecko_id") or None,
+                ]
+            )
+            imported_records += 1
+    except (ValidationError, ValueError, AttributeError, csv.Error) as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_CONTENT,
+            detail=f"Invalid record number {imported_records + 1}: {e}",
+        )
+    csv_file.seek(0)
+
+
+def _import_and_invalidate_cache(
+    db: Session, csv_file: IO[str]
+) -> List[Tuple[int, str, Optional[str]]]:
+    imported = crud.import_cryptocurrencies(session=db, csv_file=csv_file)
+    delete_cryptos_from_cache([symbol for _, symbol, _ in imported])
+    return imported
+
+
+@router.post("/cryptocurrencies/import")
+async def import_cryptocurrencies(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    format: BulkFormat = "ndjson",
+    db: Session = Depends(get_db),
+):
+    """
+    Import cryptocurrencies from NDJSON or CSV (e.g., a previous export) in the request body.
+    Each record needs a symbol and a name, optionally an amount (in the portfolio) and a coingecko_id.
+    Symbols without a coingecko_id (given or already stored) are imported as pending and listed
+    in the response, they are looked up on CoinGecko in the background like when creating
+    a cryptocurrency, and deleted if they cannot be found.
+    Existing cryptocurrencies get their name (shared by all the users) and amount overwritten,
+    a missing amount keeps the existing one. The last record of a symbol wins.
+    The metadata is fetched from CoinGecko in batches after the import has finished.
     """
-    await refresh_all_task()
-    return {"message": "Manual refresh of all currencies metadata has finished."}
+    with tempfile.TemporaryFile() as upload, tempfile.TemporaryFile(
+        mode="w+", newline=""
+    ) as csv_file:
+        # Spool the upload to disk, so that memory usage does not depend on its size
+        async for chunk in request.stream():
+            upload.write(chunk)
+        upload.seek(0)
+
+        # Parsing and database work run in a thread, off the event loop
+        await asyncio.to_thread(_write_import_records, upload, csv_file, format)
+        imported = await asyncio.to_thread(_import_and_invalidate_cache, db, csv_file)
+
+    background_tasks.add_task(enrich_imported_cryptocurrencies_metadata, imported)
+    return {
+        "message": f"Imported {len(imported)} cryptocurrencies, their metadata will be fetched in the background.",
+        "pending": [
+            symbol for _, symbol, coingecko_id in imported if coingecko_id is None
+        ],
+    }
@@ -0,0 +1,193 @@
+import logging
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.orm import Session
+
+import app.crud as crud
+import app.schemas as schemas
+from app.config import settings
+from app.db import get_db
+from app.services.coingecko import get_coin_metadata, validate_crypto_symbol
+from app.services.exchange_rates import add_valuations
+from app.services.redis import (delete_crypto_from_cache,
+                                get_cryptos_from_cache, insert_crypto_to_cache)
+
+router = APIRouter(prefix="/api")
+
+logger = logging.getLogger(__name__)
+
+
+def get_user_or_404(user_id: int, db: Session = Depends(get_db)):
+    user = crud.get_user(session=db, user_id=user_id)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"User with ID {user_id} not found",
+        )
+    return user
+
+
+def invalidate_portfolio_cache(user, symbol: str):
+    """
+    The cached cryptocurrencies hold the amounts of the default user (the portfolio of the
+    /api/cryptocurrency endpoints), drop the entry when one of its holdings changes.
+    """
+    if user.username == settings.DEFAULT_USERNAME:
+        delete_crypto_from_cache(symbol)
+
+
+@router.post(
+    "/users", response_model=schemas.User, status_code=status.HTTP_201_CREATED
+)
+def create_user(user_data: schemas.UserCreate, db: Session = Depends(get_db)):
+    """
+    Create a new user.
+    """
+    return crud.create_user(session=db, user=user_data)
+
+
+@router.get("/users/{user_id}", response_model=schemas.User)
+def get_user(user=Depends(get_user_or_404)):
+    """
+    Get details of a specific user by its ID.
+    """
+    return user
+
+
+@router.get(
+    "/users/{user_id}/holdings", response_model=List[schemas.HoldingResponse]
+)
+def get_user_holdings(
+    user_id: int,
+    currency: Optional[str] = None,
+    user=Depends(get_user_or_404),
+    db: Session = Depends(get_db),
+):
+    """
+    Get the holdings of a user, including the metadata of their cryptocurrencies.
+    Optionally, their values can be converted to another currency (e.g., EUR, CZK).
+    """
+    holdings = crud.get_user_holdings(session=db, user_id=user_id)
+    symbols = [symbol for _, symbol in holdings]
+
+    # The cryptocurrencies are shared by all users, read them from the cache first
+    cryptos = get_cryptos_from_cache(symbols)
+    missing_symbols = [symbol for symbol in symbols if symbol not in cryptos]
+    if missing_symbols:
+        cryptos.update(
+            crud.get_cryptocurrency_responses_by_symbols(
+                session=db, symbols=missing_symbols
+            )
+        )
+
+    responses = [
+        {
+            "user_id": user_id,
+            "symbol": symbol,
+            "name": cryptos[symbol]["name"],
+            "amount": holding.amount,
+            "created_at": holding.created_at,
+            "updated_at": holding.updated_at,
+            "crypto_metadata": cryptos[symbol]["crypto_metadata"],
+        }
+        for holding, symbol in holdings
+    ]
+    if currency is not None:
+        add_valuations(responses, currency)
+    return responses
+
+
+@router.post(
+    "/users/{user_id}/holdings",
+    response_model=schemas.HoldingResponse,
+    status_code=status.HTTP_201_CREATED,
+)
+async def create_user_holding(
+    user_id: int,
+    holding_data: schemas.HoldingCreate,
+    user=Depends(get_user_or_404),
+    db: Session = Depends(get_db),
+):
+    """
+    Add a cryptocurrency to the holdings of a user.
+    Cryptocurrencies not in the system yet are added first (like with POST /api/cryptocurrency),
+    the cryptocurrency and its metadata are then shared with all other users holding it.
+    """
+    symbol = holding_data.symbol.upper()  # Ensure the symbol is in uppercase
+
+    crypto = crud.get_cryptocurrency_by_symbol(session=db, symbol=symbol)
+    if not crypto:
+        coingecko_id = await validate_crypto_symbol(symbol)
+        coin_metadata = await get_coin_metadata(coingecko_id)
+        crypto = crud.create_cryptocurrency(
+            session=db,
+            crypto=schemas.CryptocurrencyCreate(
+                symbol=symbol, name=holding_data.name or symbol
+            ),
+            metadata=coin_metadata,
+        )
+        insert_crypto_to_cache(symbol=symbol, model=crypto)
+        logger.info(f"Added shared cryptocurrency '{symbol}' for user {user_id}")
+
+    holding = crud.create_holding(
+        session=db, user_id=user_id, crypto=crypto, amount=holding_data.amount
+    )
+    invalidate_portfolio_cache(user, symbol)
+    return {
+        "user_id": user_id,
+        "symbol": symbol,
+        "name": crypto.name,
+        "amount": holding.amount,
+        "created_at": holding.created_at,
+        "updated_at": holding.updated_at,
+        "crypto_metadata": crypto.crypto_metadata,
+    }
+
+
+@router.put(
+    "/users/{user_id}/holdings/{symbol}", response_model=schemas.HoldingResponse
+)
+def update_user_holding(
+    user_id: int,
+    symbol: str,
+    holding_data: schemas.HoldingUpdate,
+    user=Depends(get_user_or_404),
+    db: Session = Depends(get_db),
+):
+    """
+    Update the amount of a cryptocurrency held by a user.
+    """
+    symbol = symbol.upper()  # Ensure the symbol is in uppercase
+
+    holding = crud.update_holding(
+        session=db, user_id=user_id, symbol=symbol, holding=holding_data
+    )
+    invalidate_portfolio_cache(user, symbol)
+    return {
+        "user_id": user_id,
+        "symbol": symbol,
+        "name": holding.cryptocurrency.name,
+        "amount": holding.amount,
+        "created_at": holding.created_at,
+        "updated_at": holding.updated_at,
+        "crypto_metadata": holding.cryptocurrency.crypto_metadata,
+    }
+
+
+@router.delete(
+    "/users/{user_id}/holdings/{symbol}", status_code=status.HTTP_204_NO_CONTENT
+)
+def delete_user_holding(
+    user_id: int,
+    symbol: str,
+    user=Depends(get_user_or_404),
+    db: Session = Depends(get_db),
+):
+    """
+    Remove a cryptocurrency from the holdings of a user (the shared cryptocurrency is kept).
+    """
+    symbol = symbol.upper()  # Ensure the symbol is in uppercase
+
+    crud.delete_holding(session=db, user_id=user_id, symbol=symbol)
+    invalidate_portfolio_cache(user, symbol)
@@ -20,16 +20,51 @@ class Settings(BaseSettings):
     REDIS_PORT: int = 6381
     REDIS_DB: int = 0
 
+    # Users settings
+    # Owner of the portfolio managed through the /api/cryptocurrency endpoints (created on startup)
+    DEFAULT_USERNAME: str = "default"
+
     # CoinGecko API settings
     COINGECKO_API_URL: str = "https://api.coingecko.com/api/v3"
     REFRESH_INTERVAL_MINUTES: int = 5  # Automatic refresh interval for all metadata
+    COINGECKO_SEARCH_TIMEOUT_SECONDS: float = 5.0
+    COINGECKO_SEARCH_CONCURRENCY: int = 4  # Concurrent /search requests looking up imported coins
+    COINGECKO_COIN_TIMEOUT_SECONDS: float = 5.0
+    COINGECKO_MAX_RETRIES: int = 2
+    COINGECKO_RETRY_BACKOFF_SECONDS: float = 0.5  # Base of the jittered exponential backoff
+    COINGECKO_RETRY_BUDGET_RATIO: float = 0.2  # Retries allowed per request made
+    COINGECKO_BREAKER_FAILURE_THRESHOLD: int = 5  # Consecutive failures to open the breaker
+    COINGECKO_BREAKER_RESET_SECONDS: float = 30.0
+    # Send a second (hedged) single-coin request if the first one is slower than this
+    COINGECKO_HEDGE_DELAY_SECONDS: Optional[float] = None
+    # Expiration of the last known metadata, served while CoinGecko is unavailable
+    COINGECKO_LAST_KNOWN_METADATA_TTL_SECONDS: int = 7 * 24 * 3600
+    COINGECKO_MARKETS_BATCH_SIZE: int = 250  # Coins per /coins/markets request (max 250)
+    REFRESH_BATCH_SIZE: int = 250  # Coins per batch of the refresh work queue
+    REFRESH_WORKER_ENABLED: bool = True  # Run a refresh worker in this process
+    REFRESH_RECLAIM_IDLE_SECONDS: int = 300  # Batches unacknowledged for longer are reclaimed
+    REFRESH_MAX_DELIVERIES: int = 5  # Batches delivered more times are dropped
+    EXCHANGE_RATES_REFRESH_INTERVAL_MINUTES: int = 60  # Refresh interval of the FX table
+
+    # Profiling settings
+    PROFILING_HEADER: str = "X-Profile-Request"  # Requests with this header are profiled
+    PROFILING_SAMPLE_RATE: float = 0.0  # Fraction of all requests profiled
+    PROFILING_SAMPLE_INTERVAL_MS: float = 5.0  # Interval of the stack sampling
+    PROFILING_BUFFER_SIZE: int = 50  # Number of captured profiles kept
+    PROFILING_ADMIN_TOKEN: Optional[str] = None  # Required in X-Admin-Token, admin endpoints are disabled when not set
+    SLOW_QUERY_THRESHOLD_MS: float = 200.0  # SQL statements slower than this are logged
 
     @property
     def get_database_url(self) -> str:
-        """Generate database URL from components if not explicitly provided via docker compose"""
+        """
+        Generate database URL from components if not explicitly provided via docker compose.
+        The psycopg2 driver is always selected, the bulk import relies on its COPY support.
+        """
         if self.DATABASE_URL:
+            if self.DATABASE_URL.startswith("postgresql://"):
+                return "postgresql+psycopg2://" + self.DATABASE_URL[len("postgresql://") :]
             return self.DATABASE_URL
-        return f"postgresql://{self.POSTGRES_USER}:{self.POSTGRES_PASSWORD}@{self.POSTGRES_HOST}:{self.POSTGRES_PORT}/{self.POSTGRES_DB}"
+        return f"postgresql+psycopg2://{self.POSTGRES_USER}:{self.POSTGRES_PASSWORD}@{self.POSTGRES_HOST}:{self.POSTGRES_PORT}/{self.POSTGRES_DB}"
 
     class Config:
         case_sensitive = True
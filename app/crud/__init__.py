@@ -1,6 +1,24 @@
-from app.crud.crypto_crud import (create_cryptocurrency, delete_cryptocurrency,
+from app.crud.alert_crud import (create_price_alert, deactivate_price_alerts,
+                                 delete_price_alert, get_price_alerts)
+from app.crud.bulk_crud import (bulk_update_cryptocurrencies_metadata,
+                                import_cryptocurrencies,
+                                stream_cryptocurrency_responses)
+from app.crud.crypto_crud import (add_cryptocurrency_to_portfolio,
+                                  create_cryptocurrency, delete_cryptocurrency,
                                   delete_cryptocurrency_by_symbol,
-                                  get_all_cryptocurrencies, get_cryptocurrency,
+                                  delete_unlisted_cryptocurrencies,
+                                  get_all_cryptocurrencies,
+                                  get_all_cryptocurrency_responses,
+                                  get_cryptocurrency,
                                   get_cryptocurrency_by_symbol,
+                                  get_cryptocurrency_response_by_symbol,
+                                  get_cryptocurrency_responses_by_symbols,
+                                  get_pending_cryptocurrencies,
+                                  get_refreshable_cryptocurrencies,
+                                  set_pending_coingecko_ids, sync_read_model,
                                   update_cryptocurrency,
                                   update_cryptocurrency_metadata)
+from app.crud.user_crud import (create_holding, create_user, delete_holding,
+                                get_default_user, get_user, get_user_holding,
+                                get_user_holdings, migrate_legacy_amounts,
+                                update_holding)
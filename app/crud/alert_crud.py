@@ -0,0 +1,100 @@
+import datetime
+from typing import List, Optional
+
+from fastapi import HTTPException, status
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+import app.models as models
+import app.schemas as schemas
+
+
+def get_price_alerts(
+    session: Session,
+    active: Optional[bool] = None,
+    limit: Optional[int] = None,
+    alert_ids: Optional[List[int]] = None,
+) -> List[models.PriceAlert]:
+    """
+    Retrieve price alerts (optionally only the active or the inactive ones, or only those
+    with the given IDs) up to a specified limit.
+    """
+    query = session.query(models.PriceAlert).order_by(models.PriceAlert.id)
+    if active is not None:
+        query = query.filter(models.PriceAlert.active == active)
+    if alert_ids is not None:
+        query = query.filter(models.PriceAlert.id.in_(alert_ids))
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
+def create_price_alert(
+    session: Session, alert: schemas.PriceAlertCreate
+) -> models.PriceAlert:
+    """
+    Create a new price alert record.
+    """
+    db_alert = models.PriceAlert(
+        symbol=alert.symbol,
+        metric=alert.metric,
+        direction=alert.direction,
+        threshold=alert.threshold,
+    )
+    session.add(db_alert)
+    session.commit()
+    session.refresh(db_alert)
+    return db_alert
+
+
+def delete_price_alert(session: Session, alert_id: int) -> bool:
+    """
+    Delete a price alert record.
+    Returns True if deletion was successful.
+    """
+    db_alert = (
+        session.query(models.PriceAlert)
+        .filter(models.PriceAlert.id == alert_id)
+        .first()
+    )
+    if not db_alert:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Price alert with ID {alert_id} not found",
+        )
+
+    session.delete(db_alert)
+    session.commit()
+    return True
+
+
+def deactivate_price_alerts(
+    session: Session, alert_ids: List[int]
+) -> List[models.PriceAlert]:
+    """
+    Mark the given active price alerts as triggered, with a single statement.
+    Returns the alerts which were deactivated (alerts already triggered are left out).
+    """
+    if not alert_ids:
+        return []
+    triggered_ids = [
+        alert_id
+        for (alert_id,) in session.execute(
+            update(models.PriceAlert)
+            .where(
+                models.PriceAlert.id.in_(alert_ids),
+                models.PriceAlert.active.is_(True),
+            )
+            .values(
+                active=False,
+                triggered_at=datetime.datetime.now(datetime.timezone.utc),
+            )
+            .returning(models.PriceAlert.id)
+        )
+    ]
+    session.commit()
+    return (
+        session.query(models.PriceAlert)
+        .filter(models.PriceAlert.id.in_(triggered_ids))
+        .all()
+    )
@@ -0,0 +1,156 @@
+import datetime
+from typing import IO, Any, Dict, Iterator, List, Tuple
+
+from sqlalchemy import bindparam, func, select, text, update
+from sqlalchemy.orm import Session
+
+import app.models as models
+import app.schemas as schemas
+from app.config import settings
+from app.crud.crypto_crud import sync_read_model
+
+# Columns of the import staging table, in the order of the CSV passed to COPY
+IMPORT_COLUMNS = ("row_number", "symbol", "name", "amount", "coingecko_id")
+
+# Merges the staging table into the tables in a single statement.
+# The last record of a symbol wins, with the last CoinGecko ID given for the symbol.
+# Without any, the existing CoinGecko ID is kept, or the cryptocurrency is pending
+# (its CoinGecko ID is looked up in the background).
+# The amounts are those held by the default user, a missing amount keeps the existing one.
+MERGE_IMPORT_STATEMENT = text(
+    """
+    WITH imported AS (
+        SELECT DISTINCT ON (symbol) symbol, name, amount,
+            first_value(coingecko_id) OVER (
+                PARTITION BY symbol ORDER BY coingecko_id IS NULL, row_number DESC
+            ) AS coingecko_id
+        FROM cryptocurrency_import
+        ORDER BY symbol, row_number DESC
+    ),
+    upserted AS (
+        INSERT INTO cryptocurrencies (symbol, name)
+        SELECT symbol, name FROM imported
+        ON CONFLICT (symbol) DO UPDATE
+        SET name = EXCLUDED.name, updated_at = now()
+        RETURNING id, symbol
+    ),
+    portfolio AS (
+        INSERT INTO holdings (user_id, crypto_id, amount)
+        SELECT (SELECT id FROM users WHERE username = :default_username),
+            upserted.id, imported.amount
+        FROM upserted JOIN imported ON imported.symbol = upserted.symbol
+        WHERE imported.amount IS NOT NULL
+        ON CONFLICT (user_id, crypto_id) DO UPDATE
+        SET amount = EXCLUDED.amount, updated_at = now()
+    ),
+    merged_metadata AS (
+        INSERT INTO cryptocurrency_metadata (crypto_id, coingecko_id)
+        SELECT upserted.id, imported.coingecko_id
+        FROM upserted JOIN imported ON imported.symbol = upserted.symbol
+        ON CONFLICT (crypto_id) DO UPDATE
+        SET coingecko_id = COALESCE(
+            EXCLUDED.coingecko_id, cryptocurrency_metadata.coingecko_id
+        )
+        RETURNING crypto_id, coingecko_id
+    )
+    SELECT upserted.id, upserted.symbol, merged_metadata.coingecko_id
+    FROM upserted JOIN merged_metadata ON merged_metadata.crypto_id = upserted.id
+    """
+)
+
+
+def stream_cryptocurrency_responses(
+    session: Session, batch_size: int = 1000
+) -> Iterator[Dict[str, Any]]:
+    """
+    Stream all cryptocurrencies as flat read model rows through a server-side cursor,
+    so that memory usage does not depend on the table size.
+    """
+    read_model = models.CryptocurrencyReadModel.__table__
+    result = session.execute(
+        select(read_model)
+        .order_by(read_model.c.id)
+        .execution_options(stream_results=True, yield_per=batch_size)
+    )
+    for row in result.mappings():
+        yield dict(row)
+
+
+def import_cryptocurrencies(session: Session, csv_file: IO[str]) -> List[Tuple]:
+    """
+    Bulk import cryptocurrencies from a CSV file (columns of IMPORT_COLUMNS, no header),
+    loaded with COPY into a staging table and merged into the tables in one statement.
+    Existing cryptocurrencies (by symbol) get their name overwritten, which is shared by all the users.
+    The amounts are set on the holdings of the default user.
+    Returns (id, symbol, coingecko_id) of every imported cryptocurrency, coingecko_id is None
+    for the pending ones. Neither CoinGecko IDs nor the metadata are fetched here.
+    """
+    session.execute(
+        text(
+            "CREATE TEMP TABLE cryptocurrency_import "
+            "(row_number bigint NOT NULL, symbol text NOT NULL, name text NOT NULL, "
+            "amount float, coingecko_id text) "
+            "ON COMMIT DROP"
+        )
+    )
+    # COPY goes through the psycopg2 cursor (the driver is pinned in get_database_url)
+    with session.connection().connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY cryptocurrency_import ({', '.join(IMPORT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+            csv_file,
+        )
+    imported = [
+        tuple(row)
+        for row in session.execute(
+            MERGE_IMPORT_STATEMENT, {"default_username": settings.DEFAULT_USERNAME}
+        )
+    ]
+    sync_read_model(session, crypto_ids=[crypto_id for crypto_id, _, _ in imported])
+    session.commit()
+    return imported
+
+
+def bulk_update_cryptocurrencies_metadata(
+    session: Session, metadata_by_symbol: Dict[str, schemas.CryptocurrencyMetadata]
+) -> Dict[str, datetime.datetime]:
+    """
+    Update the metadata of many cryptocurrencies (by symbol) with batched statements.
+    Like update_cryptocurrency_metadata, None values do not overwrite existing ones.
+    Returns the new updated_at of every updated cryptocurrency, by symbol.
+    """
+    if not metadata_by_symbol:
+        return {}
+
+    crypto = models.Cryptocurrency.__table__
+    metadata = models.CryptocurrencyMetadata.__table__
+    crypto_id_by_symbol = (
+        select(crypto.c.id)
+        .where(crypto.c.symbol == bindparam("b_symbol"))
+        .scalar_subquery()
+    )
+    session.execute(
+        update(metadata)
+        .where(metadata.c.crypto_id == crypto_id_by_symbol)
+        .values(
+            {
+                column: func.coalesce(bindparam(f"b_{column}"), metadata.c[column])
+                for column in schemas.CryptocurrencyMetadata.model_fields
+            }
+        ),
+        [
+            {
+                "b_symbol": symbol,
+                **{f"b_{column}": value for column, value in new_metadata},
+            }
+            for symbol, new_metadata in metadata_by_symbol.items()
+        ],
+    )
+    updated = session.execute(
+        update(crypto)
+        .where(crypto.c.symbol.in_(list(metadata_by_symbol)))
+        .values(updated_at=datetime.datetime.now(datetime.timezone.utc))
+        .returning(crypto.c.id, crypto.c.symbol, crypto.c.updated_at)
+    ).all()
+    sync_read_model(session, crypto_ids=[crypto_id for crypto_id, _, _ in updated])
+    session.commit()
+    return {symbol: updated_at for _, symbol, updated_at in updated}
@@ -1,12 +1,39 @@
 import datetime
-from typing import List, Optional
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 from fastapi import HTTPException, status
+from sqlalchemy import and_, delete, func, select
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 import app.models as models
 import app.schemas as schemas
+from app.config import settings
+
+# Columns of the read model which belong to the nested crypto_metadata object
+READ_MODEL_METADATA_COLUMNS = (
+    "current_price_usd",
+    "price_change_percentage_24h",
+    "total_volume_usd",
+    "market_cap_usd",
+    "market_cap_rank",
+    "coingecko_id",
+    "metadata_timestamp",
+)
+
+
+def _default_user_id():
+    """
+    Subquery of the ID of the default user, whose holdings are the portfolio
+    of the /api/cryptocurrency endpoints.
+    """
+    users = models.User.__table__
+    return (
+        select(users.c.id)
+        .where(users.c.username == settings.DEFAULT_USERNAME)
+        .scalar_subquery()
+    )
 
 
 def get_all_cryptocurrencies(
@@ -52,7 +79,8 @@ def create_cryptocurrency(
     metadata: Optional[schemas.CryptocurrencyMetadata],
 ) -> models.Cryptocurrency:
     """
-    Create a new cryptocurrency record.
+    Create a new cryptocurrency record, shared by all the users.
+    The amount is not stored, see add_cryptocurrency_to_portfolio.
     """
     # Check if cryptocurrency with same symbol already exists
     db_crypto = get_cryptocurrency_by_symbol(session, symbol=crypto.symbol)
@@ -66,7 +94,6 @@ def create_cryptocurrency(
     db_crypto = models.Cryptocurrency(
         name=crypto.name,
         symbol=crypto.symbol,
-        amount=crypto.amount,
     )
 
     # If metadata is provided, add it to the cryptocurrency instance
@@ -83,6 +110,8 @@ def create_cryptocurrency(
 
     try:
         session.add(db_crypto)
+        session.flush()
+        sync_read_model(session, crypto_ids=[db_crypto.id])
         session.commit()
         session.refresh(db_crypto)
         return db_crypto
@@ -94,11 +123,52 @@ def create_cryptocurrency(
         )
 
 
+def _set_portfolio_amount(session: Session, crypto_id: int, amount: float):
+    """
+    Set the amount of a cryptocurrency held by the default user, adding it to the portfolio if needed.
+    Does not commit.
+    """
+    holdings = models.Holding.__table__
+    stmt = insert(holdings).values(
+        user_id=_default_user_id(), crypto_id=crypto_id, amount=amount
+    )
+    session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[holdings.c.user_id, holdings.c.crypto_id],
+            set_={"amount": stmt.excluded.amount, "updated_at": func.now()},
+        )
+    )
+
+
+def add_cryptocurrency_to_portfolio(
+    session: Session, crypto: models.Cryptocurrency, amount: float
+):
+    """
+    Add an existing cryptocurrency to the portfolio of the /api/cryptocurrency endpoints
+    (the holdings of the default user).
+    """
+    holdings = models.Holding.__table__
+    result = session.execute(
+        insert(holdings)
+        .values(user_id=_default_user_id(), crypto_id=crypto.id, amount=amount)
+        .on_conflict_do_nothing(
+            index_elements=[holdings.c.user_id, holdings.c.crypto_id]
+        )
+    )
+    if result.rowcount == 0:
+        detail = f"Cryptocurrency with symbol '{crypto.symbol}' already exists"
+        session.rollback()
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
+    sync_read_model(session, crypto_ids=[crypto.id])
+    session.commit()
+
+
 def update_cryptocurrency(
     session: Session, symbol: str, crypto: schemas.CryptocurrencyUpdate
 ) -> models.Cryptocurrency:
     """
     Update an existing cryptocurrency record.
+    The name is shared by all the users, the amount is the one held by the default user.
     """
     db_crypto = get_cryptocurrency_by_symbol(session, symbol=symbol)
     if not db_crypto:
@@ -110,10 +180,12 @@ def update_cryptocurrency(
     # Update fields
     if crypto.name is not None:
         db_crypto.name = crypto.name
-    if crypto.amount is not None:
-        db_crypto.amount = crypto.amount
 
     try:
+        session.flush()
+        if crypto.amount is not None:
+            _set_portfolio_amount(session, crypto_id=db_crypto.id, amount=crypto.amount)
+        sync_read_model(session, crypto_ids=[db_crypto.id])
         session.commit()
         session.refresh(db_crypto)
         return db_crypto
@@ -138,6 +210,10 @@ def update_cryptocurrency_metadata(
             detail=f"Cryptocurrency with symbol '{symbol}' not found",
         )
 
+    # Cryptocurrencies imported without a CoinGecko ID may have no metadata yet
+    if db_crypto.crypto_metadata is None:
+        db_crypto.crypto_metadata = models.CryptocurrencyMetadata()
+
     # Update metadata fields
     if new_metadata.current_price_usd is not None:
         db_crypto.crypto_metadata.current_price_usd = new_metadata.current_price_usd
@@ -159,15 +235,39 @@ def update_cryptocurrency_metadata(
     # Force Cryptocurrency model to update the updated_at field
     db_crypto.updated_at = datetime.datetime.utcnow()
 
+    session.flush()
+    sync_read_model(session, crypto_ids=[db_crypto.id])
     session.commit()
     session.refresh(db_crypto)
 
     return db_crypto
 
 
+def _check_not_held_by_users(session: Session, db_crypto: models.Cryptocurrency):
+    """
+    Refuse to delete a shared cryptocurrency while users (other than the default one) hold it,
+    as their holdings would be deleted with it.
+    """
+    holders = session.execute(
+        select(func.count())
+        .select_from(models.Holding)
+        .where(
+            and_(
+                models.Holding.crypto_id == db_crypto.id,
+                models.Holding.user_id != _default_user_id(),
+            )
+        )
+    ).scalar_one()
+    if holders:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Cryptocurrency with symbol '{db_crypto.symbol}' is held by {holders} users",
+        )
+
+
 def delete_cryptocurrency(session: Session, symbol: str) -> bool:
     """
-    Delete a cryptocurrency record.
+    Delete a cryptocurrency record, unless it is held by users other than the default one.
     Returns True if deletion was successful.
     """
     db_crypto = get_cryptocurrency_by_symbol(session, symbol=symbol)
@@ -176,7 +276,13 @@ def delete_cryptocurrency(session: Session, symbol: str) -> bool:
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Cryptocurrency with symbol '{symbol}' not found",
         )
+    _check_not_held_by_users(session, db_crypto)
 
+    session.execute(
+        delete(models.CryptocurrencyReadModel).where(
+            models.CryptocurrencyReadModel.id == db_crypto.id
+        )
+    )
     session.delete(db_crypto)
     session.commit()
     return True
@@ -184,7 +290,7 @@ def delete_cryptocurrency(session: Session, symbol: str) -> bool:
 
 def delete_cryptocurrency_by_symbol(session: Session, symbol: str) -> bool:
     """
-    Delete a cryptocurrency record by its symbol.
+    Delete a cryptocurrency record by its symbol, unless it is held by users other than the default one.
     Returns True if deletion was successful.
     """
     db_crypto = get_cryptocurrency_by_symbol(session, symbol=symbol)
@@ -193,7 +299,238 @@ def delete_cryptocurrency_by_symbol(session: Session, symbol: str) -> bool:
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Cryptocurrency with symbol '{symbol}' not found",
         )
+    _check_not_held_by_users(session, db_crypto)
 
+    session.execute(
+        delete(models.CryptocurrencyReadModel).where(
+            models.CryptocurrencyReadModel.id == db_crypto.id
+        )
+    )
     session.delete(db_crypto)
     session.commit()
     return True
+
+
+def sync_read_model(session: Session, crypto_ids: Optional[Iterable[int]] = None):
+    """
+    Upsert the denormalized read model rows of the given cryptocurrencies
+    (all of them if no IDs are given) from the normalized tables.
+    Does not commit, so it runs in the same transaction as the write itself.
+    """
+    crypto = models.Cryptocurrency.__table__
+    metadata = models.CryptocurrencyMetadata.__table__
+    holdings = models.Holding.__table__
+    read_model = models.CryptocurrencyReadModel.__table__
+
+    source = select(
+        crypto.c.id,
+        crypto.c.symbol,
+        crypto.c.name,
+        holdings.c.amount,
+        crypto.c.created_at,
+        crypto.c.updated_at,
+        *[metadata.c[column] for column in READ_MODEL_METADATA_COLUMNS],
+    ).select_from(
+        crypto.outerjoin(metadata, metadata.c.crypto_id == crypto.c.id).outerjoin(
+            # The amount is the one held by the default user
+            holdings,
+            and_(
+                holdings.c.crypto_id == crypto.c.id,
+                holdings.c.user_id == _default_user_id(),
+            ),
+        )
+    )
+    if crypto_ids is not None:
+        source = source.where(crypto.c.id.in_(list(crypto_ids)))
+
+    columns = [column.name for column in source.selected_columns]
+    stmt = insert(read_model).from_select(columns, source)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[read_model.c.id],
+        set_={column: stmt.excluded[column] for column in columns if column != "id"},
+    )
+    session.execute(stmt)
+
+
+def _read_model_row_to_response(row) -> Dict[str, Any]:
+    """
+    Shape a flat read model row like schemas.CryptocurrencyResponse.
+    """
+    response = {
+        column: row[column]
+        for column in row.keys()
+        if column not in READ_MODEL_METADATA_COLUMNS
+    }
+    response["crypto_metadata"] = (
+        {column: row[column] for column in READ_MODEL_METADATA_COLUMNS}
+        if row["coingecko_id"] is not None
+        else None
+    )
+    return response
+
+
+def get_cryptocurrency_response_by_symbol(
+    session: Session, symbol: str
+) -> Optional[Dict[str, Any]]:
+    """
+    Retrieve a single cryptocurrency in the response shape from the read model,
+    using a Core select (no ORM objects are built).
+    """
+    read_model = models.CryptocurrencyReadModel.__table__
+    row = (
+        session.execute(select(read_model).where(read_model.c.symbol == symbol))
+        .mappings()
+        .first()
+    )
+    return _read_model_row_to_response(row) if row is not None else None
+
+
+def get_all_cryptocurrency_responses(
+    session: Session, limit: Optional[int] = None, portfolio_only: bool = False
+) -> List[Dict[str, Any]]:
+    """
+    Retrieve all cryptocurrencies (or only those held by the default user) up to a specified limit
+    in the response shape from the read model, using a Core select (no ORM objects are built).
+    """
+    read_model = models.CryptocurrencyReadModel.__table__
+    stmt = select(read_model).order_by(read_model.c.id)
+    if portfolio_only:
+        stmt = stmt.where(read_model.c.amount.is_not(None))
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return [
+        _read_model_row_to_response(row)
+        for row in session.execute(stmt).mappings()
+    ]
+
+
+def get_cryptocurrency_responses_by_symbols(
+    session: Session, symbols: List[str]
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Retrieve many cryptocurrencies in the response shape from the read model, by symbol.
+    """
+    read_model = models.CryptocurrencyReadModel.__table__
+    rows = session.execute(
+        select(read_model).where(read_model.c.symbol.in_(symbols))
+    ).mappings()
+    return {row["symbol"]: _read_model_row_to_response(row) for row in rows}
+
+
+def get_refreshable_cryptocurrencies(session: Session) -> List[Tuple[str, str]]:
+    """
+    Retrieve (symbol, coingecko_id) of all cryptocurrencies which have a CoinGecko ID.
+    """
+    read_model = models.CryptocurrencyReadModel.__table__
+    return [
+        tuple(row)
+        for row in session.execute(
+            select(read_model.c.symbol, read_model.c.coingecko_id)
+            .where(read_model.c.coingecko_id.is_not(None))
+            .order_by(read_model.c.id)
+        )
+    ]
+
+
+def get_pending_cryptocurrencies(
+    session: Session, after_id: int = 0, limit: int = 250
+) -> List[Tuple[int, str]]:
+    """
+    Retrieve (id, symbol) of the cryptocurrencies without a CoinGecko ID (e.g. imported without one),
+    which are still to be looked up on CoinGecko, in batches by ID.
+    """
+    read_model = models.CryptocurrencyReadModel.__table__
+    return [
+        tuple(row)
+        for row in session.execute(
+            select(read_model.c.id, read_model.c.symbol)
+            .where(read_model.c.coingecko_id.is_(None), read_model.c.id > after_id)
+            .order_by(read_model.c.id)
+            .limit(limit)
+        )
+    ]
+
+
+def set_pending_coingecko_ids(
+    session: Session, coingecko_ids: Dict[str, str]
+) -> List[Tuple[str, str]]:
+    """
+    Set the CoinGecko IDs (by symbol) of cryptocurrencies which have none yet,
+    IDs set in the meantime are not overwritten.
+    Returns (symbol, coingecko_id) of the updated cryptocurrencies.
+    """
+    if not coingecko_ids:
+        return []
+
+    crypto = models.Cryptocurrency.__table__
+    metadata = models.CryptocurrencyMetadata.__table__
+    symbols_by_id = dict(
+        session.execute(
+            select(crypto.c.id, crypto.c.symbol).where(
+                crypto.c.symbol.in_(list(coingecko_ids))
+            )
+        ).all()
+    )
+    if not symbols_by_id:
+        return []
+
+    statement = insert(metadata).values(
+        [
+            {"crypto_id": crypto_id, "coingecko_id": coingecko_ids[symbol]}
+            for crypto_id, symbol in symbols_by_id.items()
+        ]
+    )
+    updated = session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[metadata.c.crypto_id],
+            set_={"coingecko_id": statement.excluded.coingecko_id},
+            where=metadata.c.coingecko_id.is_(None),
+        ).returning(metadata.c.crypto_id, metadata.c.coingecko_id)
+    ).all()
+    sync_read_model(session, crypto_ids=[crypto_id for crypto_id, _ in updated])
+    session.commit()
+    return [(symbols_by_id[crypto_id], coingecko_id) for crypto_id, coingecko_id in updated]
+
+
+def delete_unlisted_cryptocurrencies(session: Session, symbols: List[str]) -> List[str]:
+    """
+    Delete cryptocurrencies without a CoinGecko ID which were not found on CoinGecko,
+    unless held by users other than the default one (they stay without metadata).
+    Returns the symbols of the deleted cryptocurrencies.
+    """
+    if not symbols:
+        return []
+
+    crypto = models.Cryptocurrency.__table__
+    metadata = models.CryptocurrencyMetadata.__table__
+    read_model = models.CryptocurrencyReadModel.__table__
+    holdings = models.Holding.__table__
+    held_by_users = select(holdings.c.crypto_id).where(
+        holdings.c.user_id != _default_user_id()
+    )
+    crypto_ids = (
+        session.execute(
+            select(read_model.c.id).where(
+                read_model.c.symbol.in_(symbols),
+                read_model.c.coingecko_id.is_(None),
+                read_model.c.id.not_in(held_by_users),
+            )
+        )
+        .scalars()
+        .all()
+    )
+    if not crypto_ids:
+        return []
+
+    # The holdings of the default user are deleted with the cryptocurrencies (ON DELETE CASCADE)
+    session.execute(delete(metadata).where(metadata.c.crypto_id.in_(crypto_ids)))
+    session.execute(delete(read_model).where(read_model.c.id.in_(crypto_ids)))
+    deleted = (
+        session.execute(
+            delete(crypto).where(crypto.c.id.in_(crypto_ids)).returning(crypto.c.symbol)
+        )
+        .scalars()
+        .all()
+    )
+    session.commit()
+    return deleted
@@ -0,0 +1,196 @@
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import app.models as models
+import app.schemas as schemas
+from app.config import settings
+from app.crud.crypto_crud import sync_read_model
+
+# Copies the amounts of the single portfolio (from before the users were added)
+# to the holdings of the default user
+MIGRATE_LEGACY_AMOUNTS_STATEMENT = text(
+    """
+    INSERT INTO holdings (user_id, crypto_id, amount)
+    SELECT :user_id, id, amount FROM cryptocurrencies
+    WHERE amount IS NOT NULL
+    ON CONFLICT (user_id, crypto_id) DO NOTHING
+    """
+)
+
+LEGACY_AMOUNT_COLUMN_QUERY = text(
+    """
+    SELECT EXISTS (
+        SELECT FROM information_schema.columns
+        WHERE table_schema = current_schema()
+        AND table_name = 'cryptocurrencies' AND column_name = 'amount'
+    )
+    """
+)
+
+
+def get_user(session: Session, user_id: int) -> Optional[models.User]:
+    """
+    Retrieve a single user by its ID.
+    """
+    return session.query(models.User).filter(models.User.id == user_id).first()
+
+
+def create_user(session: Session, user: schemas.UserCreate) -> models.User:
+    """
+    Create a new user record.
+    """
+    db_user = models.User(username=user.username)
+    try:
+        session.add(db_user)
+        session.commit()
+        session.refresh(db_user)
+        return db_user
+    except IntegrityError:
+        session.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"User with username '{user.username}' already exists",
+        )
+
+
+def get_default_user(session: Session) -> models.User:
+    """
+    Retrieve the default user, whose holdings are the portfolio of the /api/cryptocurrency endpoints,
+    creating it if it does not exist yet.
+    """
+    users = models.User.__table__
+    session.execute(
+        insert(users)
+        .values(username=settings.DEFAULT_USERNAME)
+        .on_conflict_do_nothing(index_elements=[users.c.username])
+    )
+    session.commit()
+    return (
+        session.query(models.User)
+        .filter(models.User.username == settings.DEFAULT_USERNAME)
+        .one()
+    )
+
+
+def migrate_legacy_amounts(session: Session) -> int:
+    """
+    One-shot migration: copy the amounts of the former cryptocurrencies.amount column
+    to the holdings of the default user and drop the column, in a single transaction,
+    so that later startups skip it. Returns the number of moved amounts.
+    """
+    default_user = get_default_user(session)
+    # Processes starting concurrently wait here, and find the column already dropped
+    session.execute(text("LOCK TABLE cryptocurrencies IN ACCESS EXCLUSIVE MODE"))
+    if not session.execute(LEGACY_AMOUNT_COLUMN_QUERY).scalar_one():
+        session.commit()
+        return 0
+
+    moved = session.execute(
+        MIGRATE_LEGACY_AMOUNTS_STATEMENT, {"user_id": default_user.id}
+    ).rowcount
+    session.execute(text("ALTER TABLE cryptocurrencies DROP COLUMN amount"))
+    sync_read_model(session)
+    session.commit()
+    return moved
+
+
+def get_user_holdings(
+    session: Session, user_id: int
+) -> List[Tuple[models.Holding, str]]:
+    """
+    Retrieve all holdings of a user, with the symbols of their cryptocurrencies.
+    The cryptocurrency metadata is not loaded, it is shared and read from the cache.
+    """
+    return (
+        session.query(models.Holding)
+        .join(models.Holding.cryptocurrency)
+        .filter(models.Holding.user_id == user_id)
+        .order_by(models.Cryptocurrency.symbol)
+        .add_columns(models.Cryptocurrency.symbol)
+        .all()
+    )
+
+
+def get_user_holding(
+    session: Session, user_id: int, symbol: str
+) -> Optional[models.Holding]:
+    """
+    Retrieve a single holding of a user by the symbol of its cryptocurrency.
+    """
+    return (
+        session.query(models.Holding)
+        .join(models.Holding.cryptocurrency)
+        .filter(
+            models.Holding.user_id == user_id,
+            models.Cryptocurrency.symbol == symbol,
+        )
+        .first()
+    )
+
+
+def create_holding(
+    session: Session, user_id: int, crypto: models.Cryptocurrency, amount: float
+) -> models.Holding:
+    """
+    Create a new holding of an existing cryptocurrency for a user.
+    """
+    db_holding = models.Holding(user_id=user_id, crypto_id=crypto.id, amount=amount)
+    try:
+        session.add(db_holding)
+        session.flush()
+        # The read model holds the amounts of the default user
+        sync_read_model(session, crypto_ids=[crypto.id])
+        session.commit()
+        session.refresh(db_holding)
+        return db_holding
+    except IntegrityError:
+        session.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"User already holds cryptocurrency with symbol '{crypto.symbol}'",
+        )
+
+
+def update_holding(
+    session: Session, user_id: int, symbol: str, holding: schemas.HoldingUpdate
+) -> models.Holding:
+    """
+    Update the amount of an existing holding.
+    """
+    db_holding = get_user_holding(session, user_id=user_id, symbol=symbol)
+    if not db_holding:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Holding of cryptocurrency with symbol '{symbol}' not found",
+        )
+
+    db_holding.amount = holding.amount
+    session.flush()
+    sync_read_model(session, crypto_ids=[db_holding.crypto_id])
+    session.commit()
+    session.refresh(db_holding)
+    return db_holding
+
+
+def delete_holding(session: Session, user_id: int, symbol: str) -> bool:
+    """
+    Delete a holding (the shared cryptocurrency is kept).
+    Returns True if deletion was successful.
+    """
+    db_holding = get_user_holding(session, user_id=user_id, symbol=symbol)
+    if not db_holding:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Holding of cryptocurrency with symbol '{symbol}' not found",
+        )
+
+    session.delete(db_holding)
+    session.flush()
+    sync_read_model(session, crypto_ids=[db_holding.crypto_id])
+    session.commit()
+    return True
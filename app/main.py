@@ -1,20 +1,44 @@
+import asyncio
+import contextlib
 import logging
 import sys
+import time
+from typing import Any, Callable, Dict, Optional
 
-from fastapi import FastAPI
+from fastapi import FastAPI, status
+from fastapi.responses import JSONResponse
 from sqlalchemy import inspect
 
 # Ensure that the models are imported so that the tables are created correctly
+import app.crud as crud
 import app.models
+from app.api import admin_router, alert_router
 from app.api import router as api_router
+from app.api import user_router
 from app.config import settings
-from app.db import Base, engine
-from app.tasks.crypto_tasks import refresh_all_cryptocurrencies_metadata
+from app.db import Base, SessionLocal, engine
+from app.models import CryptocurrencyReadModel
+from app.services.alerts import ensure_alert_index
+from app.services.exchange_rates import refresh_exchange_rates
+from app.services.profiling import instrument_engine, profile_request
+from app.services.redis import insert_missing_cryptos_to_cache
+from app.tasks.crypto_tasks import (refresh_all_cryptocurrencies_metadata,
+                                    run_refresh_worker)
 from app.tasks.scheduler import schedule_periodic_task, start_scheduler
 
 app = FastAPI()
 
+# Keeps references to the background tasks started on startup
+background_tasks = set()
+
 app.include_router(api_router)
+app.include_router(user_router)
+app.include_router(alert_router)
+app.include_router(admin_router)
+
+# Opt-in profiling of requests and slow-query logging
+app.middleware("http")(profile_request)
+instrument_engine(engine)
 
 # Configure root logger
 logging.basicConfig(
@@ -35,39 +59,199 @@ else:
     logger.setLevel(logging.INFO)
 
 
+# Durations of the startup phases in milliseconds, reported by the readiness endpoint
+startup_phases: Dict[str, float] = {}
+# Set once the caches have been warmed up
+ready = asyncio.Event()
+# Error of the last failed warm-up attempt, reported by the readiness endpoint
+warm_up_error: Optional[str] = None
+
+
+@contextlib.contextmanager
+def startup_phase(name: str):
+    """
+    Time a startup phase.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_phases[name] = (time.perf_counter() - start) * 1000
+        logger.info(f"Startup phase '{name}' took {startup_phases[name]:.1f} ms")
+
+
 @app.on_event("startup")
 async def initialize_db():
     """
-    Initialize the database on startup (creates the tables if needed).
+    Initialize the database on startup (creates the missing tables, existing ones are kept,
+    and the default user).
+    """
+    with startup_phase("schema"):
+        # A single query lists the existing tables
+        inspector = inspect(engine)
+        existing_tables = set(inspector.get_table_names())
+        missing_tables = [
+            table
+            for tablename, table in Base.metadata.tables.items()
+            if tablename not in existing_tables
+        ]
+        if missing_tables:
+            logger.info(
+                f"Creating missing database tables: {', '.join(table.name for table in missing_tables)}"
+            )
+            Base.metadata.create_all(bind=engine, tables=missing_tables)
+            if CryptocurrencyReadModel.__table__ in missing_tables:
+                # Fill the new read model from the existing tables
+                with SessionLocal() as db:
+                    crud.sync_read_model(session=db)
+                    db.commit()
+        else:
+            logger.info("Database tables already exist.")
+
+        with SessionLocal() as db:
+            # The default user owns the portfolio of the /api/cryptocurrency endpoints
+            crud.get_default_user(session=db)
+            # Before the users were added, the amounts were stored with the cryptocurrencies
+            if "cryptocurrencies" in existing_tables and "amount" in {
+                column["name"] for column in inspector.get_columns("cryptocurrencies")
+            }:
+                moved = crud.migrate_legacy_amounts(session=db)
+                logger.info(
+                    f"Moved {moved} portfolio amounts to the holdings of the default user"
+                )
+
+
+def warm_up_cache() -> int:
+    """
+    Fill Redis cache with all cryptocurrencies, streamed from the read model
+    and inserted with pipelined batches. Entries already cached (possibly fresher than
+    the streamed rows) are kept. Returns the number of inserted cryptocurrencies.
+    """
+    db = SessionLocal()
+    try:
+        return insert_missing_cryptos_to_cache(
+            crud.stream_cryptocurrency_responses(session=db)
+        )
+    finally:
+        db.close()
+
+
+def warm_up_alert_index():
+    """
+    Build the in-process index of the active price alerts.
     """
-    inspector = inspect(engine)
-    # Check if all tables already exist
-    if not all(
-        [inspector.has_table(tablename) for tablename in Base.metadata.tables.keys()]
-    ):
-        logging.info("Dropping all existing database tables...")
-        Base.metadata.drop_all(bind=engine)
-        logging.info("Creating new database tables...")
-        Base.metadata.create_all(bind=engine)
-    else:
-        logging.info("Database tables already exist.")
+    db = SessionLocal()
+    try:
+        ensure_alert_index(session=db)
+    finally:
+        db.close()
+
+
+async def run_warm_up_phase(name: str, func: Callable[[], Any]) -> Any:
+    """
+    Run a blocking warm-up phase in a thread, retrying failed attempts with a backoff
+    until it succeeds. The readiness endpoint reports the error meanwhile.
+    """
+    global warm_up_error
+    delay = 1.0
+    while True:
+        try:
+            with startup_phase(name):
+                # The database and Redis clients are synchronous, run them in a thread
+                return await asyncio.to_thread(func)
+        except Exception as e:
+            warm_up_error = f"{name}: {e!r}"
+            logger.exception(f"Startup phase '{name}' failed, retrying in {delay:.0f} s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+
+async def warm_up():
+    """
+    Warm up Redis cache and the in-process caches, then report the application as ready.
+    Each phase is retried on its own, so a failed phase does not repeat the finished ones.
+    """
+    global warm_up_error
+    count = await run_warm_up_phase("cache_warm_up", warm_up_cache)
+    logger.info(f"Warmed up Redis cache with {count} cryptocurrencies")
+    await run_warm_up_phase("alert_index", warm_up_alert_index)
+
+    warm_up_error = None
+    ready.set()
+    logger.info(
+        f"Application is ready, startup took {sum(startup_phases.values()):.1f} ms"
+    )
+
+
+async def fetch_exchange_rates():
+    """
+    Fetch the exchange rates once on startup. Only the values in other currencies need them,
+    so readiness does not wait for them, and a failure is left to the scheduled refresh.
+    """
+    try:
+        await refresh_exchange_rates()
+    except Exception:
+        logger.warning("Exchange rates could not be fetched on startup", exc_info=True)
 
 
 @app.on_event("startup")
 async def startup_event():
     """
-    Start the scheduler for periodic tasks.
+    Start the scheduler for periodic tasks and the warm-up of the caches.
     """
-    start_scheduler()
-    # Schedule the task to refresh all cryptocurrencies metadata every REFRESH_INTERVAL_MINUTES
-    schedule_periodic_task(
-        func=refresh_all_cryptocurrencies_metadata,
-        interval_minutes=settings.REFRESH_INTERVAL_MINUTES,
-        id="refresh_all_crypto_metadata",
-        name="Refresh all cryptocurrencies metadata",
-    )
+    with startup_phase("scheduler"):
+        start_scheduler()
+        # Schedule the task to refresh all cryptocurrencies metadata every REFRESH_INTERVAL_MINUTES
+        schedule_periodic_task(
+            func=refresh_all_cryptocurrencies_metadata,
+            interval_minutes=settings.REFRESH_INTERVAL_MINUTES,
+            id="refresh_all_crypto_metadata",
+            name="Refresh all cryptocurrencies metadata",
+        )
+        # Schedule the task to refresh the exchange rates every EXCHANGE_RATES_REFRESH_INTERVAL_MINUTES
+        schedule_periodic_task(
+            func=refresh_exchange_rates,
+            interval_minutes=settings.EXCHANGE_RATES_REFRESH_INTERVAL_MINUTES,
+            id="refresh_exchange_rates",
+            name="Refresh exchange rates",
+        )
+
+    # Warm up in the background, the readiness endpoint reports when it is done
+    background_tasks.add(asyncio.create_task(warm_up()))
+    background_tasks.add(asyncio.create_task(fetch_exchange_rates()))
+
+    # Start the worker processing the batches of the refresh work queue
+    if settings.REFRESH_WORKER_ENABLED:
+        background_tasks.add(asyncio.create_task(run_refresh_worker()))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    Stop the background tasks (unacknowledged refresh batches are reclaimed by other workers).
+    """
+    for task in background_tasks:
+        task.cancel()
 
 
 @app.get("/")
 async def root():
     return {"message": f"Welcome to {settings.APP_NAME}!"}
+
+
+@app.get("/ready")
+async def readiness():
+    """
+    Readiness probe, reports ready only after the caches have been warmed up.
+    Includes the durations of the startup phases in milliseconds,
+    and the error of the last failed warm-up attempt while it is being retried.
+    """
+    content = {"ready": ready.is_set(), "startup_phases_ms": startup_phases}
+    if warm_up_error is not None:
+        content["warm_up_error"] = warm_up_error
+    return JSONResponse(
+        status_code=(
+            status.HTTP_200_OK if ready.is_set() else status.HTTP_503_SERVICE_UNAVAILABLE
+        ),
+        content=content,
+    )
@@ -1 +1,4 @@
-from app.models.crypto_models import Cryptocurrency, CryptocurrencyMetadata
+from app.models.alert_models import PriceAlert
+from app.models.crypto_models import (Cryptocurrency, CryptocurrencyMetadata,
+                                      CryptocurrencyReadModel)
+from app.models.user_models import Holding, User
@@ -0,0 +1,19 @@
+from sqlalchemy import Boolean, Column, DateTime, Float, Integer, String
+from sqlalchemy.sql import func
+
+from app.db import Base
+
+
+class PriceAlert(Base):
+    __tablename__ = "price_alerts"
+
+    id = Column(Integer, primary_key=True, index=True)
+    symbol = Column(String, index=True, nullable=False)
+    metric = Column(String, nullable=False)  # Name of the metadata field watched
+    direction = Column(String, nullable=False)  # 'above' or 'below'
+    threshold = Column(Float, nullable=False)
+
+    # Alerts fire once, after which they are deactivated
+    active = Column(Boolean, default=True, index=True, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    triggered_at = Column(DateTime(timezone=True))
@@ -12,7 +12,8 @@ class Cryptocurrency(Base):
     id = Column(Integer, primary_key=True, index=True)
     symbol = Column(String, unique=True, index=True, nullable=False)
     name = Column(String, nullable=False)
-    amount = Column(Float, default=0.0)  # Amount of cryptocurrency owned
+    # The amount owned is not stored here, the cryptocurrency is shared by all the users
+    # (the /api/cryptocurrency endpoints use the holdings of the default user)
 
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     # Updates when metadata is updated or when the name is changed
@@ -44,3 +45,28 @@ class CryptocurrencyMetadata(Base):
     )  # Value fetched from Coingecko API
 
     cryptocurrency = relationship("Cryptocurrency", back_populates="crypto_metadata")
+
+
+class CryptocurrencyReadModel(Base):
+    """
+    Denormalized read model holding exactly the columns returned by the API.
+    Maintained in the same transaction as every write to the tables above.
+    """
+
+    __tablename__ = "cryptocurrency_read_model"
+
+    # Same value as Cryptocurrency.id
+    id = Column(Integer, primary_key=True)
+    symbol = Column(String, unique=True, index=True, nullable=False)
+    name = Column(String, nullable=False)
+    amount = Column(Float)  # Held by the default user, NULL when not in its portfolio
+    created_at = Column(DateTime(timezone=True))
+    updated_at = Column(DateTime(timezone=True))
+
+    current_price_usd = Column(Float)
+    price_change_percentage_24h = Column(Float)
+    total_volume_usd = Column(Float)
+    market_cap_usd = Column(Float)
+    market_cap_rank = Column(Integer)
+    coingecko_id = Column(String)  # NULL when the coin has no metadata
+    metadata_timestamp = Column(DateTime(timezone=True))
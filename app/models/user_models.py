@@ -0,0 +1,48 @@
+from sqlalchemy import (Column, DateTime, Float, ForeignKey, Integer, String,
+                        UniqueConstraint)
+from sqlalchemy.orm import relationship
+from sqlalchemy.sql import func
+
+from app.db import Base
+
+
+class User(Base):
+    __tablename__ = "users"
+
+    id = Column(Integer, primary_key=True, index=True)
+    username = Column(String, unique=True, index=True, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    holdings = relationship(
+        "Holding", back_populates="user", cascade="all, delete-orphan"
+    )
+
+
+class Holding(Base):
+    """
+    Amount of a cryptocurrency owned by a user.
+    The cryptocurrency (and its metadata) is shared by all the users holding it.
+    """
+
+    __tablename__ = "holdings"
+    __table_args__ = (UniqueConstraint("user_id", "crypto_id"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(
+        Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True, nullable=False
+    )
+    crypto_id = Column(
+        Integer,
+        ForeignKey("cryptocurrencies.id", ondelete="CASCADE"),
+        index=True,
+        nullable=False,
+    )
+    amount = Column(Float, default=0.0, nullable=False)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
+
+    user = relationship("User", back_populates="holdings")
+    cryptocurrency = relationship("Cryptocurrency")
@@ -1,5 +1,10 @@
+from app.schemas.alert_schemas import (AlertDirection, AlertMetric, PriceAlert,
+                                       PriceAlertCreate)
 from app.schemas.crypto_schemas import (Cryptocurrency, CryptocurrencyBase,
                                         CryptocurrencyCreate,
                                         CryptocurrencyMetadata,
                                         CryptocurrencyResponse,
-                                        CryptocurrencyUpdate)
+                                        CryptocurrencyUpdate,
+                                        CryptocurrencyValuation)
+from app.schemas.user_schemas import (HoldingCreate, HoldingResponse,
+                                      HoldingUpdate, User, UserCreate)
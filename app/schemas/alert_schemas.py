@@ -0,0 +1,37 @@
+from datetime import datetime
+from typing import Literal, Optional
+
+from pydantic import BaseModel, Field
+
+# Metadata fields alerts can watch
+AlertMetric = Literal["current_price_usd", "price_change_percentage_24h"]
+AlertDirection = Literal["above", "below"]
+
+
+class PriceAlertCreate(BaseModel):
+    """Model for creating a new price alert"""
+
+    symbol: str = Field(
+        ...,
+        description="Cryptocurrency symbol (e.g., BTC, ETH)",
+        min_length=1,
+        max_length=10,
+    )
+    metric: AlertMetric = Field(
+        "current_price_usd", description="Metadata field watched by the alert"
+    )
+    direction: AlertDirection = Field(
+        ..., description="Fire when the value rises above or falls below the threshold"
+    )
+    threshold: float = Field(..., description="Threshold value of the metric")
+
+
+class PriceAlert(PriceAlertCreate):
+    """Complete price alert model including database fields"""
+
+    id: int
+    active: bool
+    created_at: datetime
+    triggered_at: Optional[datetime] = None
+
+    model_config = {"from_attributes": True}
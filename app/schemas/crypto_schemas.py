@@ -70,6 +70,18 @@ class CryptocurrencyMetadata(BaseModel):
         json_encoders = {datetime: lambda v: v.isoformat()}
 
 
+class CryptocurrencyValuation(BaseModel):
+    """Model for cryptocurrency values converted from USD to another currency"""
+
+    currency: str = Field(..., description="Currency of the values (e.g., eur, czk)")
+    current_price: Optional[float] = Field(None, description="Current price")
+    total_volume: Optional[float] = Field(None, description="24h trading volume")
+    market_cap: Optional[float] = Field(None, description="Market capitalization")
+    holdings_value: Optional[float] = Field(
+        None, description="Value of the amount of cryptocurrency owned"
+    )
+
+
 class Cryptocurrency(CryptocurrencyBase):
     """Complete cryptocurrency model including database fields"""
 
@@ -85,6 +97,8 @@ class CryptocurrencyResponse(Cryptocurrency):
     """Response model including metadata"""
 
     crypto_metadata: Optional[CryptocurrencyMetadata] = None
+    # Only present when a currency is requested
+    valuation: Optional[CryptocurrencyValuation] = None
 
     model_config = {
         "from_attributes": True,
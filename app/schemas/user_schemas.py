@@ -0,0 +1,60 @@
+from datetime import datetime
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+from app.schemas.crypto_schemas import (CryptocurrencyMetadata,
+                                        CryptocurrencyValuation)
+
+
+class UserCreate(BaseModel):
+    """Model for creating a new user"""
+
+    username: str = Field(..., description="Unique username", min_length=1, max_length=50)
+
+
+class User(UserCreate):
+    """Complete user model including database fields"""
+
+    id: int
+    created_at: datetime
+
+    model_config = {"from_attributes": True}
+
+
+class HoldingUpdate(BaseModel):
+    """Model for updating the amount of a cryptocurrency held by a user"""
+
+    amount: float = Field(..., description="Amount of cryptocurrency owned", ge=0.0)
+
+
+class HoldingCreate(HoldingUpdate):
+    """Model for adding a cryptocurrency to the holdings of a user"""
+
+    symbol: str = Field(
+        ...,
+        description="Cryptocurrency symbol (e.g., BTC, ETH)",
+        min_length=1,
+        max_length=10,
+    )
+    name: Optional[str] = Field(
+        None,
+        description="Full name of the cryptocurrency, used if it is not in the system yet",
+        min_length=1,
+        max_length=100,
+    )
+
+
+class HoldingResponse(BaseModel):
+    """Response model of a holding, including the shared cryptocurrency metadata"""
+
+    user_id: int
+    symbol: str
+    name: str
+    amount: float
+    created_at: datetime
+    updated_at: datetime
+
+    crypto_metadata: Optional[CryptocurrencyMetadata] = None
+    # Only present when a currency is requested
+    valuation: Optional[CryptocurrencyValuation] = None
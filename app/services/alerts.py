@@ -0,0 +1,239 @@
+# Incremental evaluation of price alerts against per-symbol sorted threshold indexes
+import bisect
+import logging
+import math
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple, get_args
+
+from sqlalchemy.orm import Session
+
+import app.crud as crud
+import app.models as models
+import app.schemas as schemas
+from app.services.redis import (add_fired_alert_to_stream,
+                                add_price_alert_change_to_stream,
+                                get_price_alert_changes_from_stream,
+                                get_price_alerts_version)
+
+logger = logging.getLogger(__name__)
+
+# (symbol, metric, old value, new value) of a refreshed coin
+MetricChange = Tuple[str, str, Optional[float], Optional[float]]
+
+
+class ThresholdIndex:
+    """
+    Active alerts kept in sorted lists of (threshold, alert ID), one per (symbol, metric, direction).
+    Only the alerts whose thresholds lie between the old and the new value are looked at.
+    """
+
+    def __init__(self):
+        self.thresholds: Dict[Tuple[str, str, str], List[Tuple[float, int]]] = (
+            defaultdict(list)
+        )
+        self.alerts: Dict[int, Tuple[Tuple[str, str, str], float]] = {}
+
+    def add(
+        self, alert_id: int, symbol: str, metric: str, direction: str, threshold: float
+    ):
+        # Adding an alert again replaces it, so that changes can be applied more than once
+        self.remove(alert_id)
+        key = (symbol, metric, direction)
+        bisect.insort(self.thresholds[key], (threshold, alert_id))
+        self.alerts[alert_id] = (key, threshold)
+
+    def remove(self, alert_id: int):
+        if alert_id not in self.alerts:
+            return
+        key, threshold = self.alerts.pop(alert_id)
+        thresholds = self.thresholds[key]
+        del thresholds[bisect.bisect_left(thresholds, (threshold, alert_id))]
+
+    def crossed(
+        self, symbol: str, metric: str, old_value: float, new_value: float
+    ) -> List[int]:
+        """IDs of the alerts whose thresholds were crossed when moving from old_value to new_value"""
+        if new_value > old_value:
+            # Rising: 'above' alerts with old_value < threshold <= new_value
+            thresholds = self.thresholds.get((symbol, metric, "above"), [])
+            start = bisect.bisect_right(thresholds, (old_value, math.inf))
+            end = bisect.bisect_right(thresholds, (new_value, math.inf))
+        elif new_value < old_value:
+            # Falling: 'below' alerts with new_value <= threshold < old_value
+            thresholds = self.thresholds.get((symbol, metric, "below"), [])
+            start = bisect.bisect_left(thresholds, (new_value, -math.inf))
+            end = bisect.bisect_left(thresholds, (old_value, -math.inf))
+        else:
+            return []
+        return [alert_id for _, alert_id in thresholds[start:end]]
+
+
+alert_index = ThresholdIndex()
+# Version of the price alerts the index is up to date with (None when not built yet)
+alert_index_version: Optional[int] = None
+alert_index_lock = threading.Lock()
+
+
+def _apply_price_alert_change(change: Dict[str, str]):
+    if change["op"] == "add":
+        alert_index.add(
+            int(change["alert_id"]),
+            change["symbol"],
+            change["metric"],
+            change["direction"],
+            float(change["threshold"]),
+        )
+    else:
+        for alert_id in change["alert_ids"].split(","):
+            alert_index.remove(int(alert_id))
+
+
+def ensure_alert_index(session: Session) -> List[int]:
+    """
+    Bring the index up to date with the alerts changed (possibly by another process) since,
+    by applying the changes from the Redis stream. The index is only built from the database
+    on cold start, or when the changes were already trimmed from the stream.
+    Returns the IDs of the alerts added to the index by the applied changes.
+    """
+    global alert_index, alert_index_version
+    with alert_index_lock:
+        if alert_index_version is not None:
+            changes = get_price_alert_changes_from_stream(alert_index_version)
+            if changes is not None:
+                added = []
+                for version, change in changes:
+                    _apply_price_alert_change(change)
+                    alert_index_version = version
+                    if change["op"] == "add":
+                        added.append(int(change["alert_id"]))
+                return [alert_id for alert_id in added if alert_id in alert_index.alerts]
+            logger.warning("Price alert changes missed, rebuilding the price alert index")
+
+        # Changes made while the index is built are applied again afterwards, which is harmless
+        version = get_price_alerts_version()
+        index = ThresholdIndex()
+        for alert in crud.get_price_alerts(session=session, active=True):
+            index.add(
+                alert.id, alert.symbol, alert.metric, alert.direction, alert.threshold
+            )
+        alert_index, alert_index_version = index, version
+        logger.info(f"Built price alert index of {len(index.alerts)} active alerts")
+        return []
+
+
+def notify_price_alert_created(alert: models.PriceAlert):
+    """Add the alert to the alert indexes of all processes, call after creating an alert"""
+    add_price_alert_change_to_stream(
+        {
+            "op": "add",
+            "alert_id": alert.id,
+            "symbol": alert.symbol,
+            "metric": alert.metric,
+            "direction": alert.direction,
+            "threshold": alert.threshold,
+        }
+    )
+
+
+def notify_price_alerts_removed(alert_ids: List[int]):
+    """Remove the alerts from the alert indexes of all processes, call after deleting or firing alerts"""
+    add_price_alert_change_to_stream(
+        {"op": "remove", "alert_ids": ",".join(str(alert_id) for alert_id in alert_ids)}
+    )
+
+
+def alert_condition_met(alert: models.PriceAlert, value: Optional[float]) -> bool:
+    """Check if the alert condition is already met by the current value"""
+    if value is None:
+        return False
+    if alert.direction == "above":
+        return value >= alert.threshold
+    return value <= alert.threshold
+
+
+def fire_price_alerts(
+    session: Session, alert_values: Dict[int, Tuple[Optional[float], float]]
+) -> List[models.PriceAlert]:
+    """
+    Deactivate the alerts and deliver them through the Redis stream.
+    alert_values maps alert IDs to the (old value, new value) which triggered them.
+    """
+    fired_alerts = crud.deactivate_price_alerts(
+        session=session, alert_ids=list(alert_values)
+    )
+    if not fired_alerts:
+        return []
+
+    with alert_index_lock:
+        for alert in fired_alerts:
+            alert_index.remove(alert.id)
+    for alert in fired_alerts:
+        old_value, new_value = alert_values[alert.id]
+        add_fired_alert_to_stream(
+            {
+                "alert_id": alert.id,
+                "symbol": alert.symbol,
+                "metric": alert.metric,
+                "direction": alert.direction,
+                "threshold": alert.threshold,
+                "old_value": old_value if old_value is not None else "",
+                "value": new_value,
+                "fired_at": alert.triggered_at.isoformat(),
+            }
+        )
+
+    notify_price_alerts_removed([alert.id for alert in fired_alerts])
+
+    logger.info(f"Fired {len(fired_alerts)} price alerts")
+    return fired_alerts
+
+
+def evaluate_price_alerts(
+    session: Session, changes: List[MetricChange]
+) -> List[models.PriceAlert]:
+    """
+    Evaluate the price alerts against the metric changes of a refresh batch,
+    firing the alerts whose thresholds were crossed.
+    """
+    added_ids = ensure_alert_index(session)
+
+    alert_values = {}
+    with alert_index_lock:
+        for symbol, metric, old_value, new_value in changes:
+            if old_value is None or new_value is None:
+                continue
+            for alert_id in alert_index.crossed(symbol, metric, old_value, new_value):
+                alert_values[alert_id] = (old_value, new_value)
+
+    # Alerts created since the last evaluation (e.g. during this refresh) may have missed
+    # their crossing, they fire if their condition is met by the current value
+    if added_ids:
+        added_alerts = crud.get_price_alerts(
+            session=session, active=True, alert_ids=added_ids
+        )
+        cryptos = crud.get_cryptocurrency_responses_by_symbols(
+            session=session, symbols=list({alert.symbol for alert in added_alerts})
+        )
+        for alert in added_alerts:
+            crypto = cryptos.get(alert.symbol, {})
+            value = (crypto.get("crypto_metadata") or {}).get(alert.metric)
+            if alert.id not in alert_values and alert_condition_met(alert, value):
+                alert_values[alert.id] = (None, value)
+
+    return fire_price_alerts(session, alert_values)
+
+
+def metric_changes(
+    symbol: str, old_metadata: Optional[Any], new_metadata: Optional[Any]
+) -> List[MetricChange]:
+    """List the changes of the metrics watchable by alerts between two metadata objects (ORM or schema)"""
+    return [
+        (
+            symbol,
+            metric,
+            getattr(old_metadata, metric, None),
+            getattr(new_metadata, metric, None),
+        )
+        for metric in get_args(schemas.AlertMetric)
+    ]
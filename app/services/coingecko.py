@@ -1,41 +1,242 @@
 # API calls to CoinGecko will be handled here
-from typing import Optional
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Dict, List, Optional
 
 import httpx
-from fastapi import HTTPException
+from fastapi import HTTPException, status
+from redis.exceptions import RedisError
 
 from app.config import settings
 from app.schemas import CryptocurrencyMetadata
+from app.services.profiling import HTTPX_EVENT_HOOKS
+from app.services.redis import (get_last_known_metadata_from_cache,
+                                insert_last_known_metadata_to_cache)
+
+logger = logging.getLogger(__name__)
+
+
+class CoinGeckoUnavailableError(HTTPException):
+    """Raised when CoinGecko cannot be reached (or the circuit breaker is open)"""
+
+    def __init__(self, detail: str):
+        super().__init__(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=detail)
+
+
+class CircuitBreaker:
+    """
+    Stops calling an endpoint after a number of consecutive failures.
+    After the reset timeout, a single probe request is let through (half-open state),
+    which closes the breaker on success or keeps it open on failure.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow_request(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            # Half-open, restart the timeout so that only one probe gets through
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"CoinGecko circuit breaker '{self.name}' closed")
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning(
+                    f"CoinGecko circuit breaker '{self.name}' opened after {self.failures} failures"
+                )
+            self.opened_at = time.monotonic()
+
+
+class RetryBudget:
+    """
+    Limits retries to a ratio of the requests made, so that retries
+    cannot multiply the load on CoinGecko during an incident.
+    """
+
+    def __init__(self, ratio: float, max_tokens: float = 10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+search_breaker = CircuitBreaker(
+    "search",
+    failure_threshold=settings.COINGECKO_BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=settings.COINGECKO_BREAKER_RESET_SECONDS,
+)
+coins_breaker = CircuitBreaker(
+    "coins",
+    failure_threshold=settings.COINGECKO_BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=settings.COINGECKO_BREAKER_RESET_SECONDS,
+)
+markets_breaker = CircuitBreaker(
+    "markets",
+    failure_threshold=settings.COINGECKO_BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=settings.COINGECKO_BREAKER_RESET_SECONDS,
+)
+exchange_rates_breaker = CircuitBreaker(
+    "exchange_rates",
+    failure_threshold=settings.COINGECKO_BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=settings.COINGECKO_BREAKER_RESET_SECONDS,
+)
+retry_budget = RetryBudget(ratio=settings.COINGECKO_RETRY_BUDGET_RATIO)
+
+# Transport of the CoinGecko clients (None for the default one, replaced in tests)
+transport: Optional[httpx.AsyncBaseTransport] = None
+
+
+async def _hedged_get(
+    client: httpx.AsyncClient, url: str, params: Dict[str, Any], hedge_delay: float
+) -> httpx.Response:
+    """Send a second identical request if the first one is slower than hedge_delay, return the first to succeed"""
+    first = asyncio.create_task(client.get(url, params=params))
+    done, _ = await asyncio.wait({first}, timeout=hedge_delay)
+    if done:
+        return first.result()
+
+    logger.info(f"Sending hedged CoinGecko request to {url}")
+    pending = {first, asyncio.create_task(client.get(url, params=params))}
+    error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _get_json(
+    breaker: CircuitBreaker,
+    url: str,
+    params: Dict[str, Any],
+    timeout: float,
+    hedge_delay: Optional[float] = None,
+) -> Dict[str, Any]:
+    """
+    GET a CoinGecko endpoint guarded by its circuit breaker,
+    retrying transport errors, 429s and 5xxs with jittered backoff within the retry budget.
+    """
+    if not breaker.allow_request():
+        raise CoinGeckoUnavailableError(
+            f"CoinGecko '{breaker.name}' endpoint is unavailable, try again later"
+        )
+    retry_budget.deposit()
+
+    attempt = 0
+    while True:
+        try:
+            async with httpx.AsyncClient(
+                timeout=timeout, event_hooks=HTTPX_EVENT_HOOKS, transport=transport
+            ) as client:
+                if hedge_delay is None:
+                    response = await client.get(url, params=params)
+                else:
+                    response = await _hedged_get(client, url, params, hedge_delay)
+            if (
+                response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+                or response.status_code >= 500
+            ):
+                response.raise_for_status()
+            breaker.record_success()
+            return response.json()
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            breaker.record_failure()
+            logger.warning(f"CoinGecko request to {url} failed: {e!r}")
+            if (
+                attempt >= settings.COINGECKO_MAX_RETRIES
+                or breaker.is_open
+                or not retry_budget.withdraw()
+            ):
+                raise CoinGeckoUnavailableError(
+                    f"CoinGecko '{breaker.name}' endpoint is unavailable, try again later"
+                ) from e
+            attempt += 1
+            # Full jitter exponential backoff
+            await asyncio.sleep(
+                random.uniform(0, settings.COINGECKO_RETRY_BACKOFF_SECONDS * 2**attempt)
+            )
+
+
+def _remember_metadata(metadata: CryptocurrencyMetadata):
+    """Store the last known metadata, a Redis failure must not fail a successful fetch"""
+    try:
+        insert_last_known_metadata_to_cache(metadata)
+    except RedisError:
+        logger.exception(
+            f"Failed to store the last known metadata of '{metadata.coingecko_id}'"
+        )
 
 
 async def validate_crypto_symbol(symbol: str) -> str:
     """Validate if a cryptocurrency symbol exists on Coingecko and if so, return its CoinGecko ID"""
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            f"{settings.COINGECKO_API_URL}/search", params={"query": symbol}
+    data = await _get_json(
+        search_breaker,
+        f"{settings.COINGECKO_API_URL}/search",
+        params={"query": symbol},
+        timeout=settings.COINGECKO_SEARCH_TIMEOUT_SECONDS,
+    )
+
+    matching_coins = [
+        coin
+        for coin in data.get("coins", [])
+        if coin.get("symbol", "").upper() == symbol.upper()
+    ]
+
+    if not matching_coins:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Cryptocurrency with symbol '{symbol}' not found on CoinGecko",
         )
-        data = response.json()
-
-        matching_coins = [
-            coin
-            for coin in data.get("coins", [])
-            if coin.get("symbol", "").upper() == symbol.upper()
-        ]
-
-        if not matching_coins:
-            raise HTTPException(
-                status_code=404,
-                detail=f"Cryptocurrency with symbol '{symbol}' not found on CoinGecko",
-            )
 
-        # The responses are already sorted in descending order by market cap
-        return matching_coins[0].get("id")
+    # The responses are already sorted in descending order by market cap
+    return matching_coins[0].get("id")
 
 
 async def get_coin_metadata(coin_id: str) -> CryptocurrencyMetadata:
-    """Fetch detailed metadata for a coin by its Coingecko ID"""
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
+    """
+    Fetch detailed metadata for a coin by its Coingecko ID.
+    While CoinGecko is unavailable, the last known metadata is served from cache instead.
+    """
+    try:
+        response_json = await _get_json(
+            coins_breaker,
             f"{settings.COINGECKO_API_URL}/coins/{coin_id}",
             params={
                 "market_data": "true",
@@ -44,58 +245,127 @@ async def get_coin_metadata(coin_id: str) -> CryptocurrencyMetadata:
                 "community_data": "false",
                 "developer_data": "false",
             },
+            timeout=settings.COINGECKO_COIN_TIMEOUT_SECONDS,
+            hedge_delay=settings.COINGECKO_HEDGE_DELAY_SECONDS,
         )
-        response_json = response.json()
-
-        # I have no idea how reliable CoinGecko API is
-        if "market_data" not in response_json:
-            return CryptocurrencyMetadata(
-                coingecko_id=coin_id,
-                market_cap_rank=(
-                    response_json["market_cap_rank"]
-                    if "market_cap_rank" in response_json
-                    else None
-                ),
-                metadata_timestamp=(
-                    response_json["last_updated"]
-                    if "last_updated" in response_json
-                    else None
-                ),
+    except CoinGeckoUnavailableError:
+        try:
+            last_known_metadata = get_last_known_metadata_from_cache(coin_id)
+        except RedisError:
+            logger.exception(f"Failed to read the last known metadata of '{coin_id}'")
+            last_known_metadata = None
+        if last_known_metadata is None:
+            raise
+        logger.warning(f"Serving last known metadata of '{coin_id}' from cache")
+        return last_known_metadata
+
+    metadata = _parse_coin_metadata(coin_id, response_json)
+    _remember_metadata(metadata)
+    return metadata
+
+
+async def get_coins_metadata(coin_ids: List[str]) -> List[CryptocurrencyMetadata]:
+    """
+    Fetch the metadata of many coins by their Coingecko IDs,
+    with one /coins/markets request per COINGECKO_MARKETS_BATCH_SIZE coins.
+    Coins unknown to CoinGecko are left out of the result.
+    """
+    all_metadata = []
+    batch_size = settings.COINGECKO_MARKETS_BATCH_SIZE
+    for i in range(0, len(coin_ids), batch_size):
+        data = await _get_json(
+            markets_breaker,
+            f"{settings.COINGECKO_API_URL}/coins/markets",
+            params={
+                "vs_currency": "usd",
+                "ids": ",".join(coin_ids[i : i + batch_size]),
+                "per_page": batch_size,
+            },
+            timeout=settings.COINGECKO_COIN_TIMEOUT_SECONDS,
+        )
+        for coin in data:
+            metadata = CryptocurrencyMetadata(
+                current_price_usd=coin.get("current_price"),
+                price_change_percentage_24h=coin.get("price_change_percentage_24h"),
+                total_volume_usd=coin.get("total_volume"),
+                market_cap_usd=coin.get("market_cap"),
+                market_cap_rank=coin.get("market_cap_rank"),
+                coingecko_id=coin["id"],
+                metadata_timestamp=coin.get("last_updated"),
             )
+            _remember_metadata(metadata)
+            all_metadata.append(metadata)
+    return all_metadata
+
 
+async def get_exchange_rates() -> Dict[str, float]:
+    """Fetch the BTC-denominated exchange rates of all currencies supported by CoinGecko"""
+    data = await _get_json(
+        exchange_rates_breaker,
+        f"{settings.COINGECKO_API_URL}/exchange_rates",
+        params={},
+        timeout=settings.COINGECKO_SEARCH_TIMEOUT_SECONDS,
+    )
+    return {
+        currency.lower(): rate["value"]
+        for currency, rate in data.get("rates", {}).items()
+        if rate.get("value")
+    }
+
+
+def _parse_coin_metadata(
+    coin_id: str, response_json: Dict[str, Any]
+) -> CryptocurrencyMetadata:
+    """Extract the metadata fields from the CoinGecko /coins/{id} response"""
+    # I have no idea how reliable CoinGecko API is
+    if "market_data" not in response_json:
         return CryptocurrencyMetadata(
-            current_price_usd=(
-                response_json["market_data"]["current_price"]["usd"]
-                if "current_price" in response_json["market_data"]
-                and "usd" in response_json["market_data"]["current_price"]
-                else None
-            ),
-            price_change_percentage_24h=(
-                response_json["market_data"]["price_change_percentage_24h"]
-                if "price_change_percentage_24h" in response_json["market_data"]
-                else None
-            ),
-            total_volume_usd=(
-                response_json["market_data"]["total_volume"]["usd"]
-                if "total_volume" in response_json["market_data"]
-                and "usd" in response_json["market_data"]["total_volume"]
-                else None
-            ),
-            market_cap_usd=(
-                response_json["market_data"]["market_cap"]["usd"]
-                if "market_cap" in response_json["market_data"]
-                and "usd" in response_json["market_data"]["market_cap"]
-                else None
-            ),
+            coingecko_id=coin_id,
             market_cap_rank=(
                 response_json["market_cap_rank"]
                 if "market_cap_rank" in response_json
                 else None
             ),
-            coingecko_id=coin_id,
             metadata_timestamp=(
                 response_json["last_updated"]
                 if "last_updated" in response_json
                 else None
             ),
         )
+
+    return CryptocurrencyMetadata(
+        current_price_usd=(
+            response_json["market_data"]["current_price"]["usd"]
+            if "current_price" in response_json["market_data"]
+            and "usd" in response_json["market_data"]["current_price"]
+            else None
+        ),
+        price_change_percentage_24h=(
+            response_json["market_data"]["price_change_percentage_24h"]
+            if "price_change_percentage_24h" in response_json["market_data"]
+            else None
+        ),
+        total_volume_usd=(
+            response_json["market_data"]["total_volume"]["usd"]
+            if "total_volume" in response_json["market_data"]
+            and "usd" in response_json["market_data"]["total_volume"]
+            else None
+        ),
+        market_cap_usd=(
+            response_json["market_data"]["market_cap"]["usd"]
+            if "market_cap" in response_json["market_data"]
+            and "usd" in response_json["market_data"]["market_cap"]
+            else None
+        ),
+        market_cap_rank=(
+            response_json["market_cap_rank"]
+            if "market_cap_rank" in response_json
+            else None
+        ),
+        coingecko_id=coin_id,
+        metadata_timestamp=(
+            response_json["last_updated"]
+            if "last_updated" in response_json
+            else None
+        ),
+    )
@@ -0,0 +1,75 @@
+# Conversion of the USD values to other currencies, computed locally from a cached FX table
+import logging
+from typing import Any, Dict, List, Optional
+
+from fastapi import HTTPException, status
+
+from app.services.coingecko import get_exchange_rates
+from app.services.redis import (get_exchange_rates_from_cache,
+                                insert_exchange_rates_to_cache)
+
+logger = logging.getLogger(__name__)
+
+# In-process copy of the BTC-denominated exchange rates (units of currency per 1 BTC)
+exchange_rates: Dict[str, float] = {}
+
+
+async def refresh_exchange_rates():
+    """
+    Task to refresh the exchange rate table from CoinGecko (a single upstream request),
+    storing it both in memory and in Redis, so that other processes can share it.
+    """
+    rates = await get_exchange_rates()
+    exchange_rates.clear()
+    exchange_rates.update(rates)
+    insert_exchange_rates_to_cache(rates)
+    logger.info(f"Refreshed exchange rates of {len(rates)} currencies")
+
+
+def get_usd_conversion_rate(currency: str) -> float:
+    """Get the rate converting USD values to the given currency"""
+    if not exchange_rates:
+        # Another process may have already fetched the table
+        exchange_rates.update(get_exchange_rates_from_cache() or {})
+    if "usd" not in exchange_rates:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Exchange rates are not available yet, try again later",
+        )
+
+    currency = currency.lower()
+    if currency not in exchange_rates:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Currency '{currency}' is not supported",
+        )
+    return exchange_rates[currency] / exchange_rates["usd"]
+
+
+def _convert(value: Optional[float], rate: float) -> Optional[float]:
+    return value * rate if value is not None else None
+
+
+def add_valuations(
+    responses: List[Dict[str, Any]], currency: str
+) -> List[Dict[str, Any]]:
+    """
+    Add the valuation in the given currency to cryptocurrency responses (dictionaries).
+    The conversion rate is looked up once for the whole list.
+    """
+    rate = get_usd_conversion_rate(currency)
+    currency = currency.lower()
+    for response in responses:
+        metadata = response.get("crypto_metadata") or {}
+        price = _convert(metadata.get("current_price_usd"), rate)
+        amount = response.get("amount")
+        response["valuation"] = {
+            "currency": currency,
+            "current_price": price,
+            "total_volume": _convert(metadata.get("total_volume_usd"), rate),
+            "market_cap": _convert(metadata.get("market_cap_usd"), rate),
+            "holdings_value": (
+                price * amount if price is not None and amount is not None else None
+            ),
+        }
+    return responses
@@ -0,0 +1,271 @@
+# Opt-in per-request profiling (span breakdown and sampling profile) and slow-query logging
+import collections
+import contextlib
+import contextvars
+import hmac
+import logging
+import random
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Set
+
+import httpx
+from fastapi import Request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+MAX_SPANS_PER_PROFILE = 1000
+MAX_STACK_DEPTH = 64
+
+
+class StackSampler:
+    """
+    Samples the stacks of the given threads in a background thread,
+    counting them in the folded format understood by flame graph tools.
+    thread_ids may grow while sampling.
+    """
+
+    def __init__(self, interval: float, thread_ids: Set[int]):
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.samples: Dict[str, int] = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> Dict[str, int]:
+        self._stop.set()
+        self._thread.join()
+        return dict(self.samples)
+
+    def _run(self):
+        names: Dict[int, str] = {}
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id not in self.thread_ids:
+                    continue
+                if thread_id not in names:
+                    names = {
+                        thread.ident: thread.name for thread in threading.enumerate()
+                    }
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[";".join(reversed(stack))] += 1
+
+
+class RequestProfile:
+    """Spans (SQL statements, Redis commands, outbound HTTP calls) and samples of one request"""
+
+    def __init__(self, method: str, path: str):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.duration_ms: Optional[float] = None
+        self.status_code: Optional[int] = None
+        self.spans: List[Dict[str, Any]] = []
+        self.dropped_spans = 0
+        self.samples: Dict[str, int] = {}
+        # Threads which ran a part of the request (the handling thread and the threads of
+        # sync endpoints and dependencies, registered by their spans), only those are sampled
+        self.thread_ids: Set[int] = {threading.get_ident()}
+        self._lock = threading.Lock()
+
+    def add_span(self, kind: str, name: str, start: float, end: float, **details):
+        self.thread_ids.add(threading.get_ident())
+        with self._lock:
+            if len(self.spans) >= MAX_SPANS_PER_PROFILE:
+                self.dropped_spans += 1
+                return
+            self.spans.append(
+                {
+                    "kind": kind,
+                    "name": name,
+                    "start_ms": (start - self._start) * 1000,
+                    "duration_ms": (end - start) * 1000,
+                    **details,
+                }
+            )
+
+    def finish(self, status_code: Optional[int], samples: Dict[str, int]):
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+        self.status_code = status_code
+        self.samples = samples
+
+    def summary(self) -> Dict[str, Any]:
+        breakdown = collections.defaultdict(lambda: {"count": 0, "duration_ms": 0.0})
+        for span in self.spans:
+            breakdown[span["kind"]]["count"] += 1
+            breakdown[span["kind"]]["duration_ms"] += span["duration_ms"]
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "status_code": self.status_code,
+            "breakdown": dict(breakdown),
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            **self.summary(),
+            "spans": self.spans,
+            "dropped_spans": self.dropped_spans,
+            # The event loop thread is shared with the other requests handled at the same time
+            "samples_scope": "threads which ran the request",
+            "samples": self.samples,
+        }
+
+
+# Profile of the request being handled (propagated to the threadpool of sync endpoints)
+current_profile: contextvars.ContextVar[Optional[RequestProfile]] = (
+    contextvars.ContextVar("current_profile", default=None)
+)
+
+# Ring buffer of the captured profiles, the oldest are dropped
+captured_profiles: collections.deque = collections.deque(
+    maxlen=settings.PROFILING_BUFFER_SIZE
+)
+
+
+def get_captured_profiles() -> List[RequestProfile]:
+    """Snapshot of the captured profiles, oldest first (the buffer is appended to concurrently)"""
+    return list(captured_profiles)
+
+
+def get_captured_profile(profile_id: str) -> Optional[RequestProfile]:
+    for profile in get_captured_profiles():
+        if profile.id == profile_id:
+            return profile
+    return None
+
+
+@contextlib.contextmanager
+def profile_span(kind: str, name: str, **details):
+    """Record the enclosed block as a span of the current request profile (if any)"""
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_span(kind, name, start, time.perf_counter(), **details)
+
+
+def _truncate(value: Any, length: int = 1000) -> str:
+    value = repr(value)
+    return value if len(value) <= length else value[:length] + "..."
+
+
+def instrument_engine(engine: Engine):
+    """Time every SQL statement, recording it in the current profile and logging the slow ones"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # Kept on the execution context, so that nothing is left over when the statement fails
+        if context is not None:
+            context._profiling_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_profiling_start", None)
+        if start is None:
+            return
+        end = time.perf_counter()
+        duration_ms = (end - start) * 1000
+
+        if duration_ms >= settings.SLOW_QUERY_THRESHOLD_MS:
+            logger.warning(
+                f"Slow query ({duration_ms:.1f} ms): {statement} parameters: {_truncate(parameters)}"
+            )
+
+        profile = current_profile.get()
+        if profile is not None:
+            profile.add_span(
+                "sql", statement, start, end, parameters=_truncate(parameters)
+            )
+
+
+async def _on_httpx_request(request: httpx.Request):
+    request.extensions["profile_start"] = time.perf_counter()
+
+
+async def _on_httpx_response(response: httpx.Response):
+    profile = current_profile.get()
+    start = response.request.extensions.get("profile_start")
+    if profile is not None and start is not None:
+        profile.add_span(
+            "http",
+            f"{response.request.method} {response.request.url}",
+            start,
+            time.perf_counter(),
+            status_code=response.status_code,
+        )
+
+
+# Pass to httpx clients, to record outbound calls in the current profile
+HTTPX_EVENT_HOOKS = {"request": [_on_httpx_request], "response": [_on_httpx_response]}
+
+
+def is_admin(request: Request) -> bool:
+    """Check the admin token, no request is an admin one unless PROFILING_ADMIN_TOKEN is set"""
+    if settings.PROFILING_ADMIN_TOKEN is None:
+        return False
+    return hmac.compare_digest(
+        request.headers.get("X-Admin-Token", "").encode(),
+        settings.PROFILING_ADMIN_TOKEN.encode(),
+    )
+
+
+def should_profile(request: Request) -> bool:
+    """
+    Profile requests sent with the profiling header (by an admin) or a random sample of them.
+    Without PROFILING_ADMIN_TOKEN, the profiling header is ignored.
+    """
+    if request.headers.get(settings.PROFILING_HEADER) and is_admin(request):
+        return True
+    return random.random() < settings.PROFILING_SAMPLE_RATE
+
+
+async def profile_request(request: Request, call_next):
+    """Middleware capturing the profile of the selected requests into the ring buffer"""
+    if not should_profile(request):
+        return await call_next(request)
+
+    profile = RequestProfile(request.method, request.url.path)
+    token = current_profile.set(profile)
+    sampler = StackSampler(
+        settings.PROFILING_SAMPLE_INTERVAL_MS / 1000, profile.thread_ids
+    )
+    sampler.start()
+    response = None
+    try:
+        response = await call_next(request)
+    finally:
+        profile.finish(
+            response.status_code if response is not None else None, sampler.stop()
+        )
+        current_profile.reset(token)
+        captured_profiles.append(profile)
+
+    logger.info(
+        f"Captured profile {profile.id} of {profile.method} {profile.path} ({profile.duration_ms:.1f} ms)"
+    )
+    response.headers["X-Profile-Id"] = profile.id
+    return response
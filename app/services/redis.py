@@ -1,48 +1,436 @@
+import datetime
 import json
 import logging
-from typing import Optional
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
 from redis import Redis
+from redis.exceptions import ResponseError
 
 import app.models as models
 import app.schemas as schemas
 from app.config import settings
+from app.services.profiling import profile_span
 
 logger = logging.getLogger(__name__)
 
-redis_client = Redis(
+
+class ProfiledRedis(Redis):
+    """Redis client recording its commands (and pipelines) in the current request profile"""
+
+    def execute_command(self, *args, **options):
+        with profile_span("redis", str(args[0])):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, *args, **kwargs):
+        pipeline = super().pipeline(*args, **kwargs)
+        execute = pipeline.execute
+
+        def profiled_execute(*execute_args, **execute_kwargs):
+            with profile_span("redis", f"PIPELINE ({len(pipeline.command_stack)} commands)"):
+                return execute(*execute_args, **execute_kwargs)
+
+        pipeline.execute = profiled_execute
+        return pipeline
+
+
+redis_client = ProfiledRedis(
     host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB
 )
 
+# Cryptocurrencies are cached as Redis hashes with short field codes,
+# so that single fields can be updated without rewriting the whole entry
+CRYPTO_FIELD_CODES = {
+    "id": "i",
+    "symbol": "s",
+    "name": "n",
+    "amount": "a",
+    "created_at": "c",
+    "updated_at": "u",
+}
+METADATA_FIELD_CODES = {
+    "current_price_usd": "p",
+    "price_change_percentage_24h": "x",
+    "total_volume_usd": "v",
+    "market_cap_usd": "m",
+    "market_cap_rank": "r",
+    "coingecko_id": "g",
+    "metadata_timestamp": "t",
+}
+INTEGER_FIELDS = {"id", "market_cap_rank"}
+STRING_FIELDS = {"symbol", "name", "coingecko_id"}
+TIMESTAMP_FIELDS = {"created_at", "updated_at", "metadata_timestamp"}
+FIELD_NAMES = {
+    code: name
+    for name, code in {**CRYPTO_FIELD_CODES, **METADATA_FIELD_CODES}.items()
+}
+
+# Sets the given fields only if the hash exists (so that no partial entry is created)
+UPDATE_EXISTING_HASH_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HSET', KEYS[1], unpack(ARGV))
+    return 1
+end
+return 0
+"""
+update_existing_hash = redis_client.register_script(UPDATE_EXISTING_HASH_SCRIPT)
+
+# The inverse, sets the hash (ARGV[1] is its expiration) only if it does not exist yet,
+# so that a fresher entry written in the meantime is not overwritten
+insert_missing_hash = redis_client.register_script(
+    """
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+        redis.call('EXPIRE', KEYS[1], ARGV[1])
+        return 1
+    end
+    return 0
+    """
+)
+
+
+def _crypto_key(symbol: str) -> str:
+    return f"crypto:{symbol}"
+
+
+def _encode_value(name: str, value: Any) -> str:
+    """Encode a field value, timestamps are stored as (UTC) epoch seconds"""
+    if name in TIMESTAMP_FIELDS:
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return repr(value.timestamp())
+    return str(value)
+
+
+def _decode_value(name: str, value: bytes) -> Any:
+    value = value.decode()
+    if name in STRING_FIELDS:
+        return value
+    if name in INTEGER_FIELDS:
+        return int(value)
+    if name in TIMESTAMP_FIELDS:
+        return datetime.datetime.fromtimestamp(float(value), tz=datetime.timezone.utc)
+    return float(value)
+
+
+def encode_fields(values: Dict[str, Any]) -> Dict[str, str]:
+    """Encode a dictionary of (long) field names to the compact hash fields, None values are skipped"""
+    codes = {**CRYPTO_FIELD_CODES, **METADATA_FIELD_CODES}
+    return {
+        codes[name]: _encode_value(name, value)
+        for name, value in values.items()
+        if value is not None
+    }
+
+
+def encode_crypto(value: schemas.CryptocurrencyResponse) -> Dict[str, str]:
+    """Encode a cryptocurrency response to the compact hash fields"""
+    values = value.model_dump(include=set(CRYPTO_FIELD_CODES))
+    if value.crypto_metadata is not None:
+        values.update(value.crypto_metadata.model_dump(include=set(METADATA_FIELD_CODES)))
+    return encode_fields(values)
+
+
+def decode_crypto(fields: Dict[bytes, bytes]) -> Dict[str, Any]:
+    """Decode the compact hash fields to the shape of a cryptocurrency response"""
+    values = {}
+    for code, value in fields.items():
+        name = FIELD_NAMES[code.decode()]
+        values[name] = _decode_value(name, value)
+
+    response = {name: values.get(name) for name in CRYPTO_FIELD_CODES}
+    response["crypto_metadata"] = (
+        {name: values.get(name) for name in METADATA_FIELD_CODES}
+        if "coingecko_id" in values
+        else None
+    )
+    return response
+
 
 def check_crypto_in_cache(symbol: str) -> bool:
     """Check if cryptocurrency data exists in Redis cache"""
-    return redis_client.exists(symbol) > 0
+    return redis_client.exists(_crypto_key(symbol)) > 0
 
 
-def get_crypto_from_cache(symbol: str) -> Optional[schemas.CryptocurrencyResponse]:
+def get_crypto_from_cache(symbol: str) -> Optional[Dict[str, Any]]:
     """Get cryptocurrency data from Redis cache"""
-    data = redis_client.get(symbol)
-    if data:
+    fields = redis_client.hgetall(_crypto_key(symbol))
+    if fields:
         logger.info(f"Retrieved cryptocurrency '{symbol}' from Redis cache")
-        return json.loads(data)
+        return decode_crypto(fields)
     logger.info(f"Failed to retrieve cryptocurrency '{symbol}' from Redis cache")
     return None
 
 
+def get_cryptos_from_cache(symbols: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Get the data of many cryptocurrencies from Redis cache with a single pipeline, by symbol"""
+    pipeline = redis_client.pipeline(transaction=False)
+    for symbol in symbols:
+        pipeline.hgetall(_crypto_key(symbol))
+    return {
+        symbol: decode_crypto(fields)
+        for symbol, fields in zip(symbols, pipeline.execute())
+        if fields
+    }
+
+
 def insert_crypto_to_cache(
-    symbol: str, model: models.Cryptocurrency, expiration: int = 3600
+    symbol: str,
+    model: Union[models.Cryptocurrency, Dict[str, Any]],
+    expiration: int = 3600,
 ):
-    """Insert cryptocurrency data in Redis cache with expiration (default 1 hour)"""
-    # Convert the model instance to the schema
-    value = schemas.CryptocurrencyResponse.from_orm(model)
-    redis_client.setex(symbol, expiration, json.dumps(value.model_dump(), default=str))
+    """Insert cryptocurrency data in Redis cache with expiration (default 1 hour), replacing any existing entry"""
+    # Convert the model instance (or read model response) to the schema
+    value = schemas.CryptocurrencyResponse.model_validate(model, from_attributes=True)
+    key = _crypto_key(symbol)
+    pipeline = redis_client.pipeline()
+    pipeline.delete(key)
+    pipeline.hset(key, mapping=encode_crypto(value))
+    pipeline.expire(key, expiration)
+    pipeline.execute()
     logger.info(
         f"Inserted cryptocurrency '{symbol}' into Redis cache with expiration of {expiration} seconds"
     )
 
 
+def insert_missing_cryptos_to_cache(
+    cryptos: Iterable[Dict[str, Any]], expiration: int = 3600, batch_size: int = 1000
+) -> int:
+    """
+    Insert many cryptocurrencies, given as flat read model rows, in Redis cache
+    with pipelines of batch_size entries. Cryptocurrencies already in the cache are left as they are.
+    Returns the number of inserted cryptocurrencies.
+    """
+    pipeline = redis_client.pipeline(transaction=False)
+    count = 0
+    inserted = 0
+    for crypto in cryptos:
+        fields = encode_fields(crypto)
+        insert_missing_hash(
+            keys=[_crypto_key(crypto["symbol"])],
+            args=[expiration, *[item for field in fields.items() for item in field]],
+            client=pipeline,
+        )
+        count += 1
+        if count % batch_size == 0:
+            inserted += sum(pipeline.execute())
+    inserted += sum(pipeline.execute())
+    logger.info(
+        f"Inserted {inserted} cryptocurrencies into Redis cache ({count - inserted} were already cached)"
+    )
+    return inserted
+
+
+def update_crypto_fields_in_cache(symbol: str, values: Dict[str, Any]) -> bool:
+    """
+    Update only the given fields (long names, None values are skipped) of a cached cryptocurrency.
+    Returns False if the cryptocurrency is not in the cache, in which case nothing is written.
+    """
+    fields = encode_fields(values)
+    if not fields:
+        return check_crypto_in_cache(symbol)
+    args = [item for field in fields.items() for item in field]
+    updated = bool(update_existing_hash(keys=[_crypto_key(symbol)], args=args))
+    if updated:
+        logger.info(
+            f"Updated fields {sorted(values)} of cryptocurrency '{symbol}' in Redis cache"
+        )
+    return updated
+
+
 def delete_crypto_from_cache(symbol: str):
     """Delete cryptocurrency data from Redis cache"""
-    redis_client.delete(symbol)
+    redis_client.delete(_crypto_key(symbol))
     logger.info(f"Deleted cryptocurrency '{symbol}' from Redis cache")
+
+
+def delete_cryptos_from_cache(symbols: List[str], batch_size: int = 1000):
+    """Delete the data of many cryptocurrencies from Redis cache, in batches"""
+    for i in range(0, len(symbols), batch_size):
+        redis_client.delete(*[_crypto_key(symbol) for symbol in symbols[i : i + batch_size]])
+    logger.info(f"Deleted {len(symbols)} cryptocurrencies from Redis cache")
+
+
+def insert_last_known_metadata_to_cache(
+    metadata: schemas.CryptocurrencyMetadata,
+    expiration: int = settings.COINGECKO_LAST_KNOWN_METADATA_TTL_SECONDS,
+):
+    """Store the last successfully fetched CoinGecko metadata of a coin with expiration (default 7 days)"""
+    redis_client.set(
+        f"coingecko:metadata:{metadata.coingecko_id}",
+        metadata.model_dump_json(),
+        ex=expiration,
+    )
+
+
+def get_last_known_metadata_from_cache(
+    coin_id: str,
+) -> Optional[schemas.CryptocurrencyMetadata]:
+    """Get the last successfully fetched CoinGecko metadata of a coin from Redis cache"""
+    data = redis_client.get(f"coingecko:metadata:{coin_id}")
+    if data:
+        logger.info(f"Retrieved last known metadata of '{coin_id}' from Redis cache")
+        return schemas.CryptocurrencyMetadata.model_validate_json(data)
+    return None
+
+
+def insert_exchange_rates_to_cache(rates: Dict[str, float], expiration: int = 86400):
+    """Insert the BTC-denominated exchange rate table in Redis cache with expiration (default 1 day)"""
+    redis_client.setex("coingecko:exchange_rates", expiration, json.dumps(rates))
+    logger.info(f"Inserted {len(rates)} exchange rates into Redis cache")
+
+
+def get_exchange_rates_from_cache() -> Optional[Dict[str, float]]:
+    """Get the BTC-denominated exchange rate table from Redis cache"""
+    data = redis_client.get("coingecko:exchange_rates")
+    if data:
+        return json.loads(data)
+    return None
+
+
+ALERT_CHANGES_STREAM = "alerts:changes"
+
+# Increments the price alerts version and appends the change to the stream, with the new
+# version as the entry ID, in one step (so that the IDs have no gaps between versions)
+add_price_alert_change = redis_client.register_script(
+    """
+    local version = redis.call('INCR', KEYS[1])
+    redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[1], version .. '-0', unpack(ARGV, 2))
+    return version
+    """
+)
+
+
+def get_price_alerts_version() -> int:
+    """Get the version of the price alerts, incremented on every change to them"""
+    return int(redis_client.get("alerts:version") or 0)
+
+
+def add_price_alert_change_to_stream(change: Dict[str, Any], maxlen: int = 10000) -> int:
+    """Publish a change of the price alerts to all processes, returns the new version of the price alerts"""
+    args = [maxlen]
+    for field, value in change.items():
+        args.extend((field, str(value)))
+    return add_price_alert_change(
+        keys=["alerts:version", ALERT_CHANGES_STREAM], args=args
+    )
+
+
+def get_price_alert_changes_from_stream(
+    after_version: int,
+) -> Optional[List[Tuple[int, Dict[str, str]]]]:
+    """
+    Get the (version, change) of the price alert changes made after a version, oldest first.
+    Returns None if some of them were already trimmed from the stream.
+    """
+    version = get_price_alerts_version()
+    changes = [
+        (
+            int(stream_id.decode().split("-")[0]),
+            {field.decode(): value.decode() for field, value in fields.items()},
+        )
+        for stream_id, fields in redis_client.xrange(
+            ALERT_CHANGES_STREAM, min=f"{after_version + 1}-0"
+        )
+    ]
+    if changes and changes[0][0] != after_version + 1:
+        return None
+    if not changes and version > after_version:
+        return None
+    return changes
+
+
+def add_fired_alert_to_stream(fired_alert: Dict[str, Any], maxlen: int = 10000):
+    """Deliver a fired price alert through the Redis stream (keeps approximately the last maxlen alerts)"""
+    redis_client.xadd(
+        "alerts:fired",
+        {field: str(value) for field, value in fired_alert.items()},
+        maxlen=maxlen,
+        approximate=True,
+    )
+
+
+def get_fired_alerts_from_stream(count: int = 100) -> List[Dict[str, str]]:
+    """Get the most recently fired price alerts from the Redis stream"""
+    return [
+        {
+            "stream_id": stream_id.decode(),
+            **{field.decode(): value.decode() for field, value in fields.items()},
+        }
+        for stream_id, fields in redis_client.xrevrange("alerts:fired", count=count)
+    ]
+
+
+REFRESH_STREAM = "refresh:batches"
+REFRESH_GROUP = "refresh-workers"
+
+
+def ensure_refresh_group():
+    """Create the consumer group of the refresh work queue (and the stream) if it does not exist"""
+    try:
+        redis_client.xgroup_create(REFRESH_STREAM, REFRESH_GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def acquire_refresh_producer_lock(expiration_ms: int) -> bool:
+    """Acquire the lock allowing a single process to enqueue a scheduled refresh"""
+    return bool(redis_client.set("refresh:producer", "1", nx=True, px=expiration_ms))
+
+
+def enqueue_refresh_batch(coins: List[Tuple[str, str]], maxlen: int = 100000):
+    """Add a batch of (symbol, coingecko_id) to the refresh work queue"""
+    redis_client.xadd(
+        REFRESH_STREAM,
+        {"coins": json.dumps(coins)},
+        maxlen=maxlen,
+        approximate=True,
+    )
+
+
+def read_refresh_batches(
+    consumer: str, count: int = 1, block_ms: int = 5000
+) -> List[Tuple[str, List[Tuple[str, str]], int]]:
+    """
+    Read new batches from the refresh work queue (blocking for up to block_ms),
+    returns (batch ID, coins, deliveries) tuples.
+    """
+    streams = redis_client.xreadgroup(
+        REFRESH_GROUP, consumer, {REFRESH_STREAM: ">"}, count=count, block=block_ms
+    )
+    return [
+        (batch_id.decode(), json.loads(fields[b"coins"]), 1)
+        for _, messages in streams or []
+        for batch_id, fields in messages
+    ]
+
+
+def claim_stale_refresh_batches(
+    consumer: str, min_idle_ms: int, count: int = 1
+) -> List[Tuple[str, List[Tuple[str, str]], int]]:
+    """
+    Claim batches left unacknowledged for longer than min_idle_ms (e.g., by a crashed worker),
+    returns (batch ID, coins, deliveries) tuples.
+    """
+    _, messages, *_ = redis_client.xautoclaim(
+        REFRESH_STREAM, REFRESH_GROUP, consumer, min_idle_ms, count=count
+    )
+    batches = []
+    for batch_id, fields in messages:
+        if fields is None:
+            # Deleted from the stream meanwhile
+            continue
+        pending = redis_client.xpending_range(
+            REFRESH_STREAM, REFRESH_GROUP, min=batch_id, max=batch_id, count=1
+        )
+        deliveries = pending[0]["times_delivered"] if pending else 1
+        batches.append((batch_id.decode(), json.loads(fields[b"coins"]), deliveries))
+    return batches
+
+
+def ack_refresh_batch(batch_id: str):
+    """Acknowledge a processed batch and remove it from the refresh work queue"""
+    pipeline = redis_client.pipeline()
+    pipeline.xack(REFRESH_STREAM, REFRESH_GROUP, batch_id)
+    pipeline.xdel(REFRESH_STREAM, batch_id)
+    pipeline.execute()
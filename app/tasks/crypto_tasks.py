@@ -1,52 +1,275 @@
+import asyncio
+import datetime
 import logging
-from typing import List
+import os
+import socket
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, status
 
 import app.crud as crud
+from app.config import settings
 from app.db import get_db
-from app.schemas import CryptocurrencyResponse
-from app.services.coingecko import get_coin_metadata
-from app.services.redis import (check_crypto_in_cache,
-                                delete_crypto_from_cache,
-                                insert_crypto_to_cache)
+from app.schemas import CryptocurrencyMetadata
+from app.services.alerts import evaluate_price_alerts, metric_changes
+from app.services.coingecko import (CoinGeckoUnavailableError,
+                                    get_coins_metadata, search_breaker,
+                                    validate_crypto_symbol)
+from app.services.redis import (ack_refresh_batch,
+                                acquire_refresh_producer_lock,
+                                claim_stale_refresh_batches,
+                                delete_cryptos_from_cache,
+                                enqueue_refresh_batch, ensure_refresh_group,
+                                read_refresh_batches,
+                                update_crypto_fields_in_cache)
 
 logger = logging.getLogger(__name__)
 
 
-async def refresh_all_cryptocurrencies_metadata():
+def enqueue_refresh_batches(coins: List[Tuple[str, str]]) -> int:
+    """Split (symbol, coingecko_id) pairs into batches on the refresh work queue, returns the number of batches"""
+    ensure_refresh_group()
+    batch_size = settings.REFRESH_BATCH_SIZE
+    for i in range(0, len(coins), batch_size):
+        enqueue_refresh_batch(coins[i : i + batch_size])
+    return (len(coins) + batch_size - 1) // batch_size
+
+
+async def refresh_all_cryptocurrencies_metadata(force: bool = False) -> int:
     """
     Task to refresh the metadata of all cryptocurrencies.
     This task can be scheduled to run periodically or called manually from the API.
 
-    The task always creates its own database session to ensure it works correctly
-    when triggered by the scheduler.
+    The task only enqueues the coins in batches to the refresh work queue (a Redis stream),
+    the batches are then processed by the refresh workers of all processes and nodes.
+    Unless forced, only one process enqueues the coins per refresh interval.
+    The pending coins (without a CoinGecko ID) are then looked up again.
+    Returns the number of enqueued batches.
     """
+    if not force and not acquire_refresh_producer_lock(
+        settings.REFRESH_INTERVAL_MINUTES * 60 * 1000 // 2
+    ):
+        logger.info("Cryptocurrency metadata refresh already enqueued by another process")
+        return 0
+
     # Always create a new session for scheduled tasks
     db = next(get_db())
-    logger.info("Started cryptocurrency metadata refresh task")
+    try:
+        coins = crud.get_refreshable_cryptocurrencies(session=db)
+    finally:
+        db.close()
+
+    batches = enqueue_refresh_batches(coins)
+    logger.info(
+        f"Enqueued cryptocurrency metadata refresh of {len(coins)} coins in {batches} batches"
+    )
 
+    await resolve_pending_cryptocurrencies()
+    return batches
+
+
+def _get_pending_cryptocurrencies(after_id: int) -> List[Tuple[int, str]]:
+    db = next(get_db())
     try:
-        # Get all cryptocurrencies from the database
-        all_cryptos = crud.get_all_cryptocurrencies(session=db)
+        return crud.get_pending_cryptocurrencies(
+            session=db, after_id=after_id, limit=settings.REFRESH_BATCH_SIZE
+        )
+    finally:
+        db.close()
 
-        for i, crypto in enumerate(all_cryptos):
-            # Fetch metadata from CoinGecko
-            new_metadata = await get_coin_metadata(crypto.crypto_metadata.coingecko_id)
 
-            # Update the metadata in the database (and update the cache)
-            updated_crypto = crud.update_cryptocurrency_metadata(
-                session=db, symbol=crypto.symbol, new_metadata=new_metadata
-            )
-            if check_crypto_in_cache(crypto.symbol):
-                delete_crypto_from_cache(crypto.symbol)
-            insert_crypto_to_cache(symbol=crypto.symbol, model=updated_crypto)
+def _store_resolved_cryptocurrencies(
+    coingecko_ids: Dict[str, str], unlisted: List[str]
+) -> List[Tuple[str, str]]:
+    """
+    Store the resolved CoinGecko IDs, delete the coins not found on CoinGecko
+    and enqueue the resolved coins to the refresh work queue. Blocking, run in a thread.
+    Returns the resolved (symbol, coingecko_id).
+    """
+    db = next(get_db())
+    try:
+        resolved = crud.set_pending_coingecko_ids(session=db, coingecko_ids=coingecko_ids)
+        deleted = crud.delete_unlisted_cryptocurrencies(session=db, symbols=unlisted)
+    finally:
+        db.close()
 
-            logger.info(
-                f"Updated metadata for '{crypto.symbol}', progress: {i + 1}/{len(all_cryptos)}"
-            )
+    delete_cryptos_from_cache([symbol for symbol, _ in resolved] + deleted)
+    enqueue_refresh_batches(resolved)
+    if deleted:
+        logger.info(f"Deleted {len(deleted)} imported coins not found on CoinGecko")
+    return resolved
 
-        logger.info(
-            f"Completed cryptocurrency metadata refresh for all {len(all_cryptos)} coins"
+
+async def resolve_pending_cryptocurrencies() -> int:
+    """
+    Task to look up the CoinGecko IDs of the pending cryptocurrencies (imported without one),
+    like when creating a cryptocurrency, in batches of REFRESH_BATCH_SIZE coins with at most
+    COINGECKO_SEARCH_CONCURRENCY concurrent requests. The resolved coins are enqueued to the
+    refresh work queue, those not found on CoinGecko are deleted (unless held by other users).
+    While CoinGecko is unavailable, the coins stay pending until the next refresh.
+    Returns the number of resolved coins.
+    """
+    semaphore = asyncio.Semaphore(settings.COINGECKO_SEARCH_CONCURRENCY)
+
+    async def resolve(symbol: str) -> str:
+        async with semaphore:
+            return await validate_crypto_symbol(symbol)
+
+    resolved = 0
+    after_id = 0
+    while not search_breaker.is_open:
+        pending = await asyncio.to_thread(_get_pending_cryptocurrencies, after_id)
+        if not pending:
+            break
+        after_id = pending[-1][0]
+
+        symbols = [symbol for _, symbol in pending]
+        results = await asyncio.gather(
+            *(resolve(symbol) for symbol in symbols), return_exceptions=True
         )
+        coingecko_ids = {}
+        unlisted = []
+        for symbol, result in zip(symbols, results):
+            if isinstance(result, CoinGeckoUnavailableError):
+                continue
+            if isinstance(result, HTTPException) and (
+                result.status_code == status.HTTP_404_NOT_FOUND
+            ):
+                unlisted.append(symbol)
+            elif isinstance(result, Exception):
+                logger.error(f"Failed to look up '{symbol}' on CoinGecko: {result!r}")
+            else:
+                coingecko_ids[symbol] = result
+
+        stored = await asyncio.to_thread(
+            _store_resolved_cryptocurrencies, coingecko_ids, unlisted
+        )
+        resolved += len(stored)
+
+    if resolved:
+        logger.info(f"Resolved the CoinGecko IDs of {resolved} pending coins")
+    return resolved
+
+
+def _store_refresh_batch(
+    metadata_by_symbol: Dict[str, CryptocurrencyMetadata]
+) -> Dict[str, datetime.datetime]:
+    """
+    Bulk-write the fetched metadata to the database, update the cached metadata fields
+    and evaluate the price alerts. Blocking, run in a thread.
+    Returns the new updated_at of every updated cryptocurrency, by symbol.
+    """
+    db = next(get_db())
+    try:
+        # Snapshot of the old metadata for the price alerts
+        old_cryptos = crud.get_cryptocurrency_responses_by_symbols(
+            session=db, symbols=list(metadata_by_symbol)
+        )
+        updated = crud.bulk_update_cryptocurrencies_metadata(
+            session=db, metadata_by_symbol=metadata_by_symbol
+        )
+
+        changes = []
+        for symbol, updated_at in updated.items():
+            new_metadata = metadata_by_symbol[symbol]
+            # Entries not in the cache are left for the next read to miss
+            update_crypto_fields_in_cache(
+                symbol, {**new_metadata.model_dump(), "updated_at": updated_at}
+            )
+            old_metadata = old_cryptos.get(symbol, {}).get("crypto_metadata")
+            changes.extend(
+                metric_changes(
+                    symbol,
+                    CryptocurrencyMetadata(**old_metadata) if old_metadata else None,
+                    new_metadata,
+                )
+            )
+
+        # Only the alerts whose thresholds were crossed by the batch are looked at
+        evaluate_price_alerts(session=db, changes=changes)
     finally:
         db.close()
-        logger.info("Closed database connection for cryptocurrency refresh task")
+    return updated
+
+
+async def process_refresh_batch(coins: List[Tuple[str, str]]):
+    """
+    Fetch the metadata of a batch of (symbol, coingecko_id) with one CoinGecko request,
+    bulk-write it to the database, update the cached metadata fields and evaluate the price alerts.
+    """
+    # Several symbols may share a CoinGecko ID, each of them gets the metadata
+    symbols_by_coingecko_id = defaultdict(list)
+    for symbol, coingecko_id in coins:
+        symbols_by_coingecko_id[coingecko_id].append(symbol)
+    all_metadata = await get_coins_metadata(list(symbols_by_coingecko_id))
+    metadata_by_symbol = {
+        symbol: metadata
+        for metadata in all_metadata
+        for symbol in symbols_by_coingecko_id[metadata.coingecko_id]
+    }
+
+    # The database and the Redis client are synchronous, keep them off the event loop
+    updated = await asyncio.to_thread(_store_refresh_batch, metadata_by_symbol)
+
+    logger.info(f"Refreshed metadata of {len(updated)}/{len(coins)} coins in a batch")
+
+
+async def run_refresh_worker():
+    """
+    Refresh worker, consuming batches from the refresh work queue in a consumer group.
+    Batches are acknowledged after they have been processed, so batches of crashed workers
+    (or failed batches) are reclaimed after REFRESH_RECLAIM_IDLE_SECONDS by any worker.
+    """
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+    await asyncio.to_thread(ensure_refresh_group)
+    logger.info(f"Started refresh worker '{consumer}'")
+
+    while True:
+        try:
+            # The Redis client is synchronous, blocking calls run in a thread
+            batches = await asyncio.to_thread(
+                claim_stale_refresh_batches,
+                consumer,
+                settings.REFRESH_RECLAIM_IDLE_SECONDS * 1000,
+            )
+            if not batches:
+                batches = await asyncio.to_thread(read_refresh_batches, consumer)
+
+            for batch_id, coins, deliveries in batches:
+                if deliveries > settings.REFRESH_MAX_DELIVERIES:
+                    logger.error(
+                        f"Dropped refresh batch {batch_id} after {deliveries - 1} failed deliveries"
+                    )
+                else:
+                    await process_refresh_batch(coins)
+                await asyncio.to_thread(ack_refresh_batch, batch_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # The unacknowledged batch is reclaimed later
+            logger.exception("Refresh worker failed to process a batch")
+            await asyncio.sleep(5)
+
+
+async def enrich_imported_cryptocurrencies_metadata(
+    imported: List[Tuple[int, str, Optional[str]]]
+):
+    """
+    Task to fetch the metadata of bulk imported cryptocurrencies, (id, symbol, coingecko_id),
+    by enqueueing them to the refresh work queue in batches.
+    Failed batches are retried by the refresh workers like those of any other refresh.
+    The CoinGecko IDs of the pending coins (imported without one) are looked up afterwards.
+    """
+    coins = [
+        (symbol, coingecko_id)
+        for _, symbol, coingecko_id in imported
+        if coingecko_id is not None
+    ]
+    batches = await asyncio.to_thread(enqueue_refresh_batches, coins)
+    logger.info(
+        f"Enqueued metadata enrichment of {len(coins)} imported coins in {batches} batches"
+    )
+
+    if len(coins) < len(imported):
+        await resolve_pending_cryptocurrencies()
@@ -0,0 +1,14 @@
+# Standalone refresh worker, for nodes which only process the refresh work queue
+import asyncio
+import logging
+import sys
+
+from app.tasks.crypto_tasks import run_refresh_worker
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+    asyncio.run(run_refresh_worker())
@@ -0,0 +1,113 @@
+"""
+Compare the previous JSON string cache encoding with the compact hash encoding:
+memory per key, and ops/sec of an amount update (full rewrite vs. single field
+through the update_existing_hash script used by update_crypto_fields_in_cache).
+
+Run from the project root against a scratch Redis database, e.g.:
+    python -m benchmarks.cache_encoding_benchmark --coins 100000 --db 15
+
+The selected database is flushed before and after the benchmark.
+"""
+import argparse
+import datetime
+import json
+import time
+
+from redis import Redis
+
+import app.schemas as schemas
+from app.config import settings
+from app.services.redis import (UPDATE_EXISTING_HASH_SCRIPT, encode_crypto,
+                                encode_fields)
+
+
+def make_crypto(i: int) -> schemas.CryptocurrencyResponse:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return schemas.CryptocurrencyResponse(
+        id=i,
+        symbol=f"BENCH{i}",
+        name=f"Benchmark coin {i}",
+        amount=float(i),
+        created_at=now,
+        updated_at=now,
+        crypto_metadata=schemas.CryptocurrencyMetadata(
+            current_price_usd=1.0 + i,
+            price_change_percentage_24h=0.5,
+            total_volume_usd=1000.0,
+            market_cap_usd=100000.0,
+            market_cap_rank=i + 1,
+            coingecko_id=f"bench-{i}",
+            metadata_timestamp=now,
+        ),
+    )
+
+
+def run(client: Redis, name: str, write, update, coins: int, batch: int = 1000):
+    client.flushdb()
+    pipeline = client.pipeline(transaction=False)
+    for i in range(coins):
+        write(pipeline, i)
+        if (i + 1) % batch == 0:
+            pipeline.execute()
+    pipeline.execute()
+
+    sample = range(0, coins, max(1, coins // 1000))
+    memory = sum(client.memory_usage(f"{name}:{i}") for i in sample) / len(sample)
+
+    start = time.perf_counter()
+    for i in range(coins):
+        update(pipeline, i)
+        if (i + 1) % batch == 0:
+            pipeline.execute()
+    pipeline.execute()
+    ops = coins / (time.perf_counter() - start)
+
+    print(f"{name:>5}: {memory:8.1f} bytes/key, {ops:10.0f} amount updates/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--coins", type=int, default=100000)
+    parser.add_argument("--db", type=int, default=15, help="Scratch Redis database")
+    args = parser.parse_args()
+
+    client = Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=args.db)
+    # The same script update_crypto_fields_in_cache runs (EVALSHA with the EXISTS check)
+    update_existing_hash = client.register_script(UPDATE_EXISTING_HASH_SCRIPT)
+    cryptos = [make_crypto(i) for i in range(args.coins)]
+
+    def write_json(pipeline, i):
+        pipeline.setex(
+            f"json:{i}",
+            3600,
+            json.dumps(cryptos[i].model_dump(), default=str),
+        )
+
+    def update_json(pipeline, i):
+        # The previous format rewrote the whole entry on every update
+        cryptos[i].amount += 1.0
+        write_json(pipeline, i)
+
+    def write_hash(pipeline, i):
+        pipeline.hset(f"hash:{i}", mapping=encode_crypto(cryptos[i]))
+        pipeline.expire(f"hash:{i}", 3600)
+
+    def update_hash(pipeline, i):
+        # Same arguments as update_crypto_fields_in_cache(symbol, {"amount": ...})
+        cryptos[i].amount += 1.0
+        fields = encode_fields({"amount": cryptos[i].amount})
+        update_existing_hash(
+            keys=[f"hash:{i}"],
+            args=[item for field in fields.items() for item in field],
+            client=pipeline,
+        )
+
+    try:
+        run(client, "json", write_json, update_json, args.coins)
+        run(client, "hash", write_hash, update_hash, args.coins)
+    finally:
+        client.flushdb()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Fault-injecting local stub of the CoinGecko endpoints used by the app.
+
+Run it and point the app at it, e.g.:
+    STUB_LATENCY_SECONDS=3 STUB_FAILURE_RATE=0.5 uvicorn benchmarks.coingecko_stub:app --port 8001
+    COINGECKO_API_URL=http://localhost:8001/api/v3
+
+STUB_LATENCY_SECONDS - added latency of every response
+STUB_LATENCY_JITTER_SECONDS - random extra latency (uniform 0..jitter)
+STUB_FAILURE_RATE - fraction of requests answered with 503
+STUB_DOWN - when set to 1, every request fails with 503
+"""
+import asyncio
+import datetime
+import os
+import random
+
+from fastapi import FastAPI, HTTPException
+
+app = FastAPI()
+
+
+async def inject_faults():
+    latency = float(os.environ.get("STUB_LATENCY_SECONDS", 0))
+    jitter = float(os.environ.get("STUB_LATENCY_JITTER_SECONDS", 0))
+    await asyncio.sleep(latency + random.uniform(0, jitter))
+    if os.environ.get("STUB_DOWN") == "1" or random.random() < float(
+        os.environ.get("STUB_FAILURE_RATE", 0)
+    ):
+        raise HTTPException(status_code=503, detail="Injected failure")
+
+
+@app.get("/api/v3/search")
+async def search(query: str):
+    await inject_faults()
+    return {"coins": [{"id": query.lower(), "symbol": query.upper()}]}
+
+
+@app.get("/api/v3/coins/{coin_id}")
+async def coin(coin_id: str):
+    await inject_faults()
+    return {
+        "id": coin_id,
+        "market_cap_rank": random.randint(1, 1000),
+        "last_updated": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "market_data": {
+            "current_price": {"usd": random.uniform(0.01, 100000)},
+            "price_change_percentage_24h": random.uniform(-10, 10),
+            "total_volume": {"usd": random.uniform(1e6, 1e10)},
+            "market_cap": {"usd": random.uniform(1e7, 1e12)},
+        },
+    }
@@ -0,0 +1,117 @@
+"""
+Benchmark the ORM and the Core (read model) paths of GET /api/cryptocurrencies.
+
+Run from the project root against a configured database, e.g.:
+    python -m benchmarks.list_endpoint_benchmark --seed 10000 --repeat 20
+
+Seeded coins use the 'BENCH' symbol prefix and are removed afterwards.
+"""
+import argparse
+import datetime
+import time
+from typing import List
+
+from pydantic import TypeAdapter
+
+import app.crud as crud
+import app.models as models
+import app.schemas as schemas
+from app.db import Base, SessionLocal, engine
+
+response_adapter = TypeAdapter(List[schemas.CryptocurrencyResponse])
+
+
+def seed(session, count: int):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    default_user = crud.get_default_user(session)
+    for i in range(count):
+        crypto = models.Cryptocurrency(symbol=f"BENCH{i}", name=f"Benchmark coin {i}")
+        crypto.crypto_metadata = models.CryptocurrencyMetadata(
+            current_price_usd=1.0 + i,
+            price_change_percentage_24h=0.5,
+            total_volume_usd=1000.0,
+            market_cap_usd=100000.0,
+            market_cap_rank=i + 1,
+            coingecko_id=f"bench-{i}",
+            metadata_timestamp=now,
+        )
+        session.add(crypto)
+        # The amounts are those held by the default user
+        session.add(
+            models.Holding(user=default_user, cryptocurrency=crypto, amount=float(i))
+        )
+    session.flush()
+    crud.sync_read_model(session)
+    session.commit()
+
+
+def cleanup(session):
+    ids = [
+        crypto_id
+        for (crypto_id,) in session.query(models.Cryptocurrency.id).filter(
+            models.Cryptocurrency.symbol.like("BENCH%")
+        )
+    ]
+    session.query(models.CryptocurrencyReadModel).filter(
+        models.CryptocurrencyReadModel.id.in_(ids)
+    ).delete(synchronize_session=False)
+    session.query(models.CryptocurrencyMetadata).filter(
+        models.CryptocurrencyMetadata.crypto_id.in_(ids)
+    ).delete(synchronize_session=False)
+    session.query(models.Cryptocurrency).filter(
+        models.Cryptocurrency.id.in_(ids)
+    ).delete(synchronize_session=False)
+    session.commit()
+
+
+def time_path(name: str, fetch, repeat: int):
+    timings = []
+    size = 0
+    for _ in range(repeat):
+        session = SessionLocal()
+        try:
+            start = time.perf_counter()
+            # Serialize like FastAPI does for the response_model
+            responses = response_adapter.validate_python(
+                fetch(session), from_attributes=True
+            )
+            size = len(response_adapter.dump_json(responses))
+            timings.append(time.perf_counter() - start)
+        finally:
+            session.close()
+    timings.sort()
+    print(
+        f"{name:>5}: median {timings[len(timings) // 2] * 1000:8.2f} ms, "
+        f"min {timings[0] * 1000:8.2f} ms, response size {size} bytes"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--seed", type=int, default=0, help="Coins to seed")
+    parser.add_argument("--repeat", type=int, default=10, help="Runs per path")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    try:
+        if args.seed:
+            seed(session, args.seed)
+        time_path(
+            "ORM",
+            lambda s: crud.get_all_cryptocurrencies(session=s),
+            args.repeat,
+        )
+        time_path(
+            "Core",
+            lambda s: crud.get_all_cryptocurrency_responses(session=s),
+            args.repeat,
+        )
+    finally:
+        if args.seed:
+            cleanup(session)
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from app.config import settings
+from app.schemas import CryptocurrencyMetadata
+from app.services import coingecko
+from app.services.coingecko import (CircuitBreaker, CoinGeckoUnavailableError,
+                                    RetryBudget)
+
+URL = "https://coingecko.test/api/v3/ping"
+
+
+@pytest.fixture(autouse=True)
+def client_settings(monkeypatch):
+    monkeypatch.setattr(settings, "COINGECKO_RETRY_BACKOFF_SECONDS", 0.0)
+    monkeypatch.setattr(settings, "COINGECKO_MAX_RETRIES", 2)
+    monkeypatch.setattr(coingecko, "retry_budget", RetryBudget(ratio=0.2))
+
+
+def use_responses(monkeypatch, handler):
+    """Serve the CoinGecko requests with handler, returns the list of the received requests"""
+    requests = []
+
+    async def record(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        response = handler(len(requests), request)
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response
+
+    monkeypatch.setattr(coingecko, "transport", httpx.MockTransport(record))
+    return requests
+
+
+def get_json(breaker: CircuitBreaker, hedge_delay=None):
+    return asyncio.run(
+        coingecko._get_json(
+            breaker, URL, params={}, timeout=1.0, hedge_delay=hedge_delay
+        )
+    )
+
+
+def new_breaker(failure_threshold: int = 5) -> CircuitBreaker:
+    return CircuitBreaker("test", failure_threshold=failure_threshold, reset_timeout=30.0)
+
+
+def test_retries_server_errors(monkeypatch):
+    requests = use_responses(
+        monkeypatch,
+        lambda n, _: httpx.Response(503) if n == 1 else httpx.Response(200, json={"ok": 1}),
+    )
+    breaker = new_breaker()
+
+    assert get_json(breaker) == {"ok": 1}
+    assert len(requests) == 2
+    assert breaker.failures == 0
+
+
+def test_breaker_opens_after_consecutive_failures(monkeypatch):
+    monkeypatch.setattr(settings, "COINGECKO_MAX_RETRIES", 0)
+    requests = use_responses(monkeypatch, lambda n, _: httpx.Response(500))
+    breaker = new_breaker(failure_threshold=2)
+
+    for _ in range(2):
+        with pytest.raises(CoinGeckoUnavailableError):
+            get_json(breaker)
+    assert breaker.is_open
+
+    # Open breaker, no request is sent
+    with pytest.raises(CoinGeckoUnavailableError):
+        get_json(breaker)
+    assert len(requests) == 2
+
+
+def test_open_breaker_stops_retries(monkeypatch):
+    requests = use_responses(monkeypatch, lambda n, _: httpx.Response(429))
+    breaker = new_breaker(failure_threshold=1)
+
+    with pytest.raises(CoinGeckoUnavailableError):
+        get_json(breaker)
+    assert len(requests) == 1
+
+
+def test_half_open_breaker_lets_one_probe_through():
+    breaker = new_breaker(failure_threshold=1)
+    breaker.record_failure()
+    assert not breaker.allow_request()
+
+    breaker.opened_at -= breaker.reset_timeout
+    assert breaker.allow_request()
+    # Until the probe finishes, the breaker stays open
+    assert not breaker.allow_request()
+
+
+def test_half_open_probe_closes_breaker_on_success(monkeypatch):
+    use_responses(monkeypatch, lambda n, _: httpx.Response(200, json={}))
+    breaker = new_breaker(failure_threshold=1)
+    breaker.record_failure()
+    breaker.opened_at -= breaker.reset_timeout
+
+    get_json(breaker)
+    assert not breaker.is_open
+    assert breaker.failures == 0
+
+
+def test_half_open_probe_failure_keeps_breaker_open(monkeypatch):
+    requests = use_responses(monkeypatch, lambda n, _: httpx.Response(500))
+    breaker = new_breaker(failure_threshold=1)
+    breaker.record_failure()
+    breaker.opened_at -= breaker.reset_timeout
+
+    with pytest.raises(CoinGeckoUnavailableError):
+        get_json(breaker)
+    assert len(requests) == 1
+    assert breaker.is_open
+    assert not breaker.allow_request()
+
+
+def test_retry_budget_limits_retries(monkeypatch):
+    monkeypatch.setattr(coingecko, "retry_budget", RetryBudget(ratio=0.0, max_tokens=1.0))
+    requests = use_responses(monkeypatch, lambda n, _: httpx.Response(500))
+    breaker = new_breaker(failure_threshold=100)
+
+    # The only token allows one retry (out of COINGECKO_MAX_RETRIES)
+    with pytest.raises(CoinGeckoUnavailableError):
+        get_json(breaker)
+    assert len(requests) == 2
+
+    # The budget is spent, no retries
+    with pytest.raises(CoinGeckoUnavailableError):
+        get_json(breaker)
+    assert len(requests) == 3
+
+
+def test_retry_budget_refills_with_requests():
+    budget = RetryBudget(ratio=0.5, max_tokens=1.0)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw()
+
+
+def test_hedged_request_returns_the_faster_response(monkeypatch):
+    async def handler(n, _):
+        if n == 1:
+            await asyncio.sleep(1.0)
+            return httpx.Response(200, json={"request": "slow"})
+        return httpx.Response(200, json={"request": "hedged"})
+
+    requests = use_responses(monkeypatch, handler)
+
+    start = time.perf_counter()
+    assert get_json(new_breaker(), hedge_delay=0.05) == {"request": "hedged"}
+    assert time.perf_counter() - start < 1.0
+    assert len(requests) == 2
+
+
+def test_fast_request_is_not_hedged(monkeypatch):
+    requests = use_responses(monkeypatch, lambda n, _: httpx.Response(200, json={}))
+
+    get_json(new_breaker(), hedge_delay=0.5)
+    assert len(requests) == 1
+
+
+def test_coin_metadata_survives_redis_outage(monkeypatch):
+    use_responses(
+        monkeypatch,
+        lambda n, _: httpx.Response(
+            200,
+            json={"market_cap_rank": 1, "market_data": {"current_price": {"usd": 1.5}}},
+        ),
+    )
+    monkeypatch.setattr(coingecko, "coins_breaker", new_breaker())
+
+    def redis_down(*args, **kwargs):
+        raise RedisConnectionError("Redis is down")
+
+    monkeypatch.setattr(coingecko, "insert_last_known_metadata_to_cache", redis_down)
+
+    metadata = asyncio.run(coingecko.get_coin_metadata("bitcoin"))
+    assert metadata.current_price_usd == 1.5
+    assert metadata.coingecko_id == "bitcoin"
+
+
+def test_coin_metadata_falls_back_to_last_known(monkeypatch):
+    monkeypatch.setattr(settings, "COINGECKO_MAX_RETRIES", 0)
+    use_responses(monkeypatch, lambda n, _: httpx.Response(503))
+    monkeypatch.setattr(coingecko, "coins_breaker", new_breaker())
+    last_known = CryptocurrencyMetadata(coingecko_id="bitcoin", current_price_usd=1.0)
+    monkeypatch.setattr(
+        coingecko, "get_last_known_metadata_from_cache", lambda coin_id: last_known
+    )
+
+    assert asyncio.run(coingecko.get_coin_metadata("bitcoin")) == last_known